@@ -1,8 +1,17 @@
-import base64
 import struct
 import os
-from nacl.signing import SigningKey, VerifyKey
-from nacl.exceptions import BadSignatureError
+import mmap
+from contextlib import contextmanager
+from functools import lru_cache
+import nacl.bindings
+from nacl._sodium import ffi, lib
+from nacl.signing import SigningKey
+
+try:
+    # SIMD-реализация base64 с тем же API, что и у stdlib
+    import pybase64 as base64
+except ImportError:
+    import base64
 
 # Размеры полей на основании main.c в usign
 PK_ALGO = b"Ed"
@@ -19,6 +28,16 @@ PUBKEY_STRUCT = "<2s8s32s"
 # Структура подписи: pkalg(2), fingerprint(8), sig(64)
 SIG_STRUCT = "<2s8s64s"
 
+# Скомпилированные структуры, чтобы не разбирать строку формата при каждом вызове
+_SECKEY = struct.Struct(SECKEY_STRUCT)
+_PUBKEY = struct.Struct(PUBKEY_STRUCT)
+_SIG = struct.Struct(SIG_STRUCT)
+# Тип ключа определяется по размеру декодированных данных
+_KEY_KINDS = {_SECKEY.size: _SECKEY, _PUBKEY.size: _PUBKEY}
+
+# Выходные буферы libsodium сразу перезаписываются целиком, обнулять их не нужно
+_alloc = ffi.new_allocator(should_clear_after_alloc=False)
+
 def load_key(path):
     """
     Парсит signify-совместимые файлы ключей (.sec/.pub).
@@ -32,25 +51,79 @@ def load_key(path):
             raise ValueError("Неверный формат файла: отсутствует заголовок")
         
         b64_data = lines[1].strip()
-        raw_data = base64.b64decode(b64_data)
+        raw_data = base64.b64decode(b64_data, validate=True)
 
-        if len(raw_data) == struct.calcsize(SECKEY_STRUCT):
+        kind = _KEY_KINDS.get(len(raw_data))
+        if kind is None:
+            raise ValueError(f"Неверный размер данных ключа: {len(raw_data)} байт")
+
+        if kind is _SECKEY:
             # Секретный ключ
-            pkalg, kdfalg, kdfrounds, salt, checksum, fingerprint, seckey = struct.unpack(SECKEY_STRUCT, raw_data)
+            pkalg, kdfalg, kdfrounds, salt, checksum, fingerprint, seckey = _SECKEY.unpack(raw_data)
             if pkalg != PK_ALGO:
                 raise ValueError(f"Неподдерживаемый алгоритм: {pkalg}")
             # В usign seckey - это seed + pubkey. Нам нужен только seed (первые 32 байта)
             return fingerprint, seckey[:32]
-        
-        elif len(raw_data) == struct.calcsize(PUBKEY_STRUCT):
-            # Публичный ключ
-            pkalg, fingerprint, pubkey = struct.unpack(PUBKEY_STRUCT, raw_data)
-            if pkalg != PK_ALGO:
-                raise ValueError(f"Неподдерживаемый алгоритм: {pkalg}")
-            return fingerprint, pubkey
-        
-        else:
-            raise ValueError(f"Неверный размер данных ключа: {len(raw_data)} байт")
+
+        # Публичный ключ
+        pkalg, fingerprint, pubkey = _PUBKEY.unpack(raw_data)
+        if pkalg != PK_ALGO:
+            raise ValueError(f"Неподдерживаемый алгоритм: {pkalg}")
+        return fingerprint, pubkey
+
+def _file_stamp(path):
+    """Возвращает (mtime_ns, size) файла для ключа кеша."""
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+# Разобранные ключи кешируются по (path, mtime_ns, size): замена файла ключа
+# меняет отметку, и ключ перечитывается при следующем вызове.
+@lru_cache(maxsize=64)
+def _load_signing_key(path, stamp):
+    """Возвращает (fingerprint, secret_key) с 64-байтным ключом libsodium."""
+    fingerprint, seed = load_key(path)
+    _, secret_key = nacl.bindings.crypto_sign_seed_keypair(seed)
+    return fingerprint, secret_key
+
+@lru_cache(maxsize=64)
+def _load_public_key(path, stamp):
+    """Возвращает (fingerprint, pubkey)."""
+    return load_key(path)
+
+def _sign_detached(message, secret_key):
+    """
+    Возвращает 64-байтную подпись Ed25519 для буфера message.
+    Вызывает libsodium напрямую: обертка nacl.bindings копирует подписанное
+    сообщение целиком в bytes, хотя нам нужны только первые SIG_SIZE байт.
+    """
+    mlen = len(message)
+    signed = _alloc("unsigned char[]", mlen + SIG_SIZE)
+    signed_len = ffi.new("unsigned long long *")
+    if lib.crypto_sign(signed, signed_len, message, mlen, secret_key) != 0:
+        raise ValueError("Не удалось подписать сообщение")
+    return ffi.buffer(signed, SIG_SIZE)[:]
+
+def _open_signed(signed, pubkey):
+    """Проверяет буфер подпись+сообщение без копирования сообщения в bytes."""
+    signed_len = len(signed)
+    message = _alloc("unsigned char[]", max(signed_len, 1))
+    message_len = ffi.new("unsigned long long *")
+    return lib.crypto_sign_open(message, message_len, signed, signed_len, pubkey) == 0
+
+@contextmanager
+def _map_file(path):
+    """
+    Отображает файл в память (mmap) и отдает его как буфер для libsodium,
+    чтобы не копировать содержимое в Python-объект bytes.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # mmap не умеет отображать пустые файлы
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with ffi.from_buffer(mm) as buf:
+                yield buf
 
 def sign_file(file_path, key_path, sig_path=None):
     """
@@ -59,17 +132,16 @@ def sign_file(file_path, key_path, sig_path=None):
     if sig_path is None:
         sig_path = file_path + ".sig"
 
-    fingerprint, seed = load_key(key_path)
-    
-    with open(file_path, 'rb') as f:
-        message = f.read()
+    fingerprint, secret_key = _load_signing_key(key_path, _file_stamp(key_path))
 
-    # PyNaCl использует детерминированную схему Ed25519 по умолчанию
-    signing_key = SigningKey(seed)
-    signature = signing_key.sign(message).signature
+    # usign подписывает сырые байты файла (чистый Ed25519, без prehash),
+    # поэтому потоковое хеширование невозможно: отдаем libsodium mmap файла.
+    # Ed25519 детерминирован, подпись - первые SIG_SIZE байт результата.
+    with _map_file(file_path) as message:
+        signature = _sign_detached(message, secret_key)
 
     # Формируем бинарную структуру подписи
-    raw_sig = struct.pack(SIG_STRUCT, PK_ALGO, fingerprint, signature)
+    raw_sig = _SIG.pack(PK_ALGO, fingerprint, signature)
     b64_sig = base64.b64encode(raw_sig).decode('utf-8')
 
     with open(sig_path, 'w') as f:
@@ -80,42 +152,60 @@ def sign_file(file_path, key_path, sig_path=None):
         f.write(f"untrusted comment: signed by key {fp_hex}\n")
         f.write(b64_sig + "\n")
 
-def verify_file(file_path, sig_path, pubkey_path):
-    """
-    Проверяет подпись файла.
-    """
-    # Загружаем публичный ключ
-    fp_pub, pubkey = load_key(pubkey_path)
-    
-    # Загружаем подпись
-    with open(sig_path, 'r') as f:
-        lines = f.readlines()
-        if len(lines) < 2:
-            raise ValueError("Неверный формат файла подписи")
-        b64_sig = lines[1].strip()
-        raw_sig_data = base64.b64decode(b64_sig)
-    
-    if len(raw_sig_data) != struct.calcsize(SIG_STRUCT):
+def _parse_signature(data):
+    """Разбирает содержимое файла .sig (bytes), возвращает (fingerprint, signature)."""
+    lines = data.split(b"\n", 2)
+    if len(lines) < 2:
+        raise ValueError("Неверный формат файла подписи")
+    raw_sig_data = base64.b64decode(lines[1].strip(), validate=True)
+
+    if len(raw_sig_data) != _SIG.size:
         raise ValueError("Неверный размер данных подписи")
-    
-    pkalg, fp_sig, signature = struct.unpack(SIG_STRUCT, raw_sig_data)
-    
+
+    pkalg, fp_sig, signature = _SIG.unpack(raw_sig_data)
+
     if pkalg != PK_ALGO:
         raise ValueError(f"Неподдерживаемый алгоритм подписи: {pkalg}")
-    
+
+    return fp_sig, signature
+
+def _read_small(path, limit=4096):
+    """Читает небольшой файл целиком через os.read, минуя файловый объект Python."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, limit)
+    finally:
+        os.close(fd)
+
+def _verify_message(file_path, fp_sig, signature, fp_pub, pubkey):
+    """Сверяет KeyID и проверяет подпись содержимого файла."""
     # Проверка соответствия KeyID (fingerprint)
     if fp_pub != fp_sig:
         raise ValueError(f"ID ключа не совпадает: {fp_pub.hex()} != {fp_sig.hex()}")
 
+    # libsodium ожидает подпись и сообщение одним буфером: читаем файл
+    # сразу на место после подписи, без промежуточной копии.
     with open(file_path, 'rb') as f:
-        message = f.read()
+        size = os.fstat(f.fileno()).st_size
+        signed = bytearray(SIG_SIZE + size)
+        signed[:SIG_SIZE] = signature
+        if f.readinto(memoryview(signed)[SIG_SIZE:]) != size:
+            raise ValueError(f"Файл {file_path} изменился во время чтения")
 
-    verify_key = VerifyKey(pubkey)
-    try:
-        verify_key.verify(message, signature)
-        return True
-    except BadSignatureError:
-        return False
+    with ffi.from_buffer(signed) as buf:
+        return _open_signed(buf, pubkey)
+
+def verify_file(file_path, sig_path, pubkey_path):
+    """
+    Проверяет подпись файла.
+    """
+    # Загружаем публичный ключ
+    fp_pub, pubkey = _load_public_key(pubkey_path, _file_stamp(pubkey_path))
+    
+    # Загружаем подпись
+    fp_sig, signature = _parse_signature(_read_small(sig_path))
+
+    return _verify_message(file_path, fp_sig, signature, fp_pub, pubkey)
 
 def generate_keypair(key_basename, comment="OpenWrt Repo"):
     """
@@ -132,7 +222,7 @@ def generate_keypair(key_basename, comment="OpenWrt Repo"):
     fingerprint = os.urandom(8)
     
     # 1. Публичный ключ
-    raw_pub = struct.pack(PUBKEY_STRUCT, PK_ALGO, fingerprint, pubkey)
+    raw_pub = _PUBKEY.pack(PK_ALGO, fingerprint, pubkey)
     b64_pub = base64.b64encode(raw_pub).decode('utf-8')
     with open(f"{key_basename}.pub", 'w') as f:
         f.write(f"untrusted comment: {comment} public key\n")
@@ -142,9 +232,8 @@ def generate_keypair(key_basename, comment="OpenWrt Repo"):
     # seckey в usign - это seed + pubkey (64 байта)
     seckey_data = seed + pubkey
     # kdfalg=b"\x00\x00", kdfrounds=0, salt=0, checksum=0
-    raw_sec = struct.pack(SECKEY_STRUCT, 
-                          PK_ALGO, b"\x00\x00", 0, b"\x00"*16, b"\x00"*8, 
-                          fingerprint, seckey_data)
+    raw_sec = _SECKEY.pack(PK_ALGO, b"\x00\x00", 0, b"\x00"*16, b"\x00"*8,
+                           fingerprint, seckey_data)
     b64_sec = base64.b64encode(raw_sec).decode('utf-8')
     with open(f"{key_basename}.key", 'w') as f:
         f.write(f"untrusted comment: {comment} secret key\n")
@@ -1,20 +1,89 @@
 import os
 import sys
+import pwd
 import json
 import subprocess
 import argparse
 import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from flask import Flask, request, jsonify, send_from_directory, render_template
 import waitress
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor as SchedulerThreadPool
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
 # Import local modules
 import paths
 import repo_discovery
+import repo_sync
 import repo_update
 from logger_utils import logger
 
+try:
+    # Быстрый JSON-кодек на Rust; без него используется stdlib json
+    import orjson
+except ImportError:
+    orjson = None
+
 app = Flask(__name__, template_folder=str(paths.INTERNAL_DIR / 'templates'))
 
+def json_loads(raw):
+    """Разбирает JSON из bytes/str."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def json_dumps(data):
+    """Сериализует данные в JSON (UTF-8, отступ 2 пробела), возвращает bytes."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+
+def json_response(data):
+    """Формирует JSON-ответ без промежуточного jsonify."""
+    if orjson is not None:
+        return app.response_class(orjson.dumps(data), mimetype='application/json')
+    return jsonify(data)
+
+# Не более одного сканирования репозиториев одновременно
+_discover_lock = threading.Lock()
+# Время жизни результата сканирования и максимальное ожидание в запросе (секунды)
+DISCOVER_TTL = 300
+DISCOVER_TIMEOUT = 30
+# Сканирование выполняется в отдельном потоке: при таймауте запроса оно
+# продолжается, и следующий запрос дожидается того же задания.
+_discover_executor = ThreadPoolExecutor(max_workers=1)
+_discover_future = None
+_discover_cache = {"ts": 0.0, "stamp": None, "data": None}
+
+# Кеш разобранных JSON-файлов: path -> ((mtime_ns, size), data)
+_json_cache = {}
+
+def load_json_cached(path):
+    """
+    Читает JSON-файл, повторно используя разобранные данные, пока не изменились
+    mtime и размер файла. Повторный запрос стоит одного stat().
+    """
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size)
+    hit = _json_cache.get(path)
+    if hit and hit[0] == key:
+        return hit[1]
+    with open(path, 'rb') as f:
+        data = json_loads(f.read())
+    _json_cache[path] = (key, data)
+    return data
+
+def store_json_cached(path, data):
+    """
+    Атомарно записывает JSON-файл и сразу обновляет кеш, чтобы следующее
+    чтение не разбирало только что записанные данные заново.
+    """
+    paths.atomic_write(path, json_dumps(data))
+    st = os.stat(path)
+    _json_cache[path] = ((st.st_mtime_ns, st.st_size), data)
+
 @app.route('/')
 def serve_index():
     """Раздает основной файл интерфейса."""
@@ -52,8 +121,7 @@ def get_config():
     """Читает файл конфигурации источников."""
     try:
         if os.path.exists(paths.SOURCES_JSON):
-            with open(paths.SOURCES_JSON, 'r') as f:
-                return jsonify(json.load(f))
+            return json_response(load_json_cached(paths.SOURCES_JSON))
         return jsonify([])
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -62,12 +130,12 @@ def get_config():
 def save_config():
     """Сохраняет файл конфигурации источников."""
     try:
-        new_data = request.json
+        new_data = json_loads(request.get_data())
         if not isinstance(new_data, list):
             return jsonify({"error": "Config format error: Root must be a list array [...]"}), 400
         
-        with open(paths.SOURCES_JSON, 'w') as f:
-            json.dump(new_data, f, indent=2, ensure_ascii=False)
+        with open(paths.SOURCES_JSON, 'wb') as f:
+            f.write(json_dumps(new_data))
         return jsonify({"status": "saved"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -78,12 +146,11 @@ def settings():
     if request.method == 'GET':
         try:
             if os.path.exists(paths.CONFIG_JSON):
-                with open(paths.CONFIG_JSON, 'r') as f:
-                    data = json.load(f)
-                    token = data.get('github_token', '')
-                    # Mask token: show only last 4 chars
-                    masked = f"****{token[-4:]}" if len(token) > 4 else ""
-                    return jsonify({"github_token": masked, "has_token": bool(token)})
+                data = load_json_cached(paths.CONFIG_JSON)
+                token = data.get('github_token', '')
+                # Mask token: show only last 4 chars
+                masked = f"****{token[-4:]}" if len(token) > 4 else ""
+                return jsonify({"github_token": masked, "has_token": bool(token)})
             return jsonify({"github_token": "", "has_token": False})
         except Exception as e:
             return jsonify({"error": str(e)}), 500
@@ -95,13 +162,12 @@ def settings():
             
             token = new_data.get('github_token', '').strip()
             
+            # Текущий конфиг берется из кеша: файл перечитывается,
+            # только если он изменился на диске с прошлого чтения
             current_data = {}
             if os.path.exists(paths.CONFIG_JSON):
                 try:
-                    with open(paths.CONFIG_JSON, 'r') as f:
-                        content = f.read().strip()
-                        if content:
-                            current_data = json.loads(content)
+                    current_data = dict(load_json_cached(paths.CONFIG_JSON))
                 except Exception as e:
                     print(f"WARN: Could not read config.json: {e}")
                     current_data = {}
@@ -109,10 +175,7 @@ def settings():
             # Update token (allow empty string to clear it)
             current_data['github_token'] = token
                 
-            with open(paths.CONFIG_JSON, 'w') as f:
-                json.dump(current_data, f, indent=2)
-                f.flush()
-                os.fsync(f.fileno())
+            store_json_cached(paths.CONFIG_JSON, current_data)
             
             logger.info(f"DEBUG: Config saved to {paths.CONFIG_JSON}")
             return jsonify({"status": "saved"})
@@ -120,35 +183,160 @@ def settings():
             logger.error(f"ERROR: Failed to save settings: {e}")
             return jsonify({"error": str(e)}), 500
 
+def _discover_inputs_stamp():
+    """Отметка (mtime_ns, size) файлов, от которых зависит результат сканирования."""
+    stamp = []
+    for path in (paths.TRACKING_LIST, paths.CONFIG_JSON):
+        try:
+            st = os.stat(path)
+            stamp.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+def _discover_job(force, stamp):
+    """Выполняет сканирование и запоминает успешный результат."""
+    results = repo_discovery.discover_releases(force=force)
+    # Ошибки не кешируются, чтобы повторный запрос сразу пробовал снова
+    if isinstance(results, list) and not any('error' in r for r in results):
+        _discover_cache.update(ts=time.monotonic(), stamp=stamp, data=results)
+    return results
+
 @app.route('/api/discover', methods=['GET'])
 def run_discovery():
     """Запускает процесс сканирования репозиториев."""
+    # Повторные нажатия во время сканирования не должны плодить
+    # параллельные обходы GitHub API и тратить лимит запросов.
+    global _discover_future
+    if not _discover_lock.acquire(blocking=False):
+        return jsonify({"error": "Discovery already running"}), 409
     try:
         force = request.args.get('force', 'false').lower() == 'true'
-        results = repo_discovery.discover_releases(force=force)
-        return jsonify(results)
+        stamp = _discover_inputs_stamp()
+
+        cache = _discover_cache
+        if (not force and cache["data"] is not None and cache["stamp"] == stamp
+                and time.monotonic() - cache["ts"] < DISCOVER_TTL):
+            return json_response(cache["data"])
+
+        if _discover_future is None or _discover_future.done():
+            _discover_future = _discover_executor.submit(_discover_job, force, stamp)
+        try:
+            results = _discover_future.result(timeout=DISCOVER_TIMEOUT)
+        except FutureTimeoutError:
+            return jsonify({"error": "Discovery is still running, retry later"}), 504
+        return json_response(results)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    finally:
+        _discover_lock.release()
 
 @app.route('/api/update', methods=['POST'])
 def trigger_update():
     """Запускает скрипт обновления в фоне."""
     try:
         # Запускаем обновление в отдельном потоке
-        update_thread = threading.Thread(target=repo_update.run_all)
-        update_thread.start()
+        if not repo_update.start_background():
+            return jsonify({"status": "Update already running"}), 409
         return jsonify({"status": "Update started (background thread)"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def _tail_lines(f, size, count, block_size=8192):
+    """Возвращает последние count строк (bytes) открытого файла размером size."""
+    pos = size
+    chunks = deque()
+    newlines = 0
+    # Каждый блок читается ровно один раз; первая строка может быть
+    # обрезана, поэтому нужен один лишний перевод строки
+    while pos > 0 and newlines <= count:
+        step = min(block_size, pos)
+        pos -= step
+        f.seek(pos)
+        chunk = f.read(step)
+        chunks.appendleft(chunk)
+        newlines += chunk.count(b"\n")
+    return deque(b"".join(chunks).splitlines(keepends=True), maxlen=count)
+
+def tail_file(path, count=50, block_size=8192):
+    """Возвращает последние count строк файла, читая его с конца блоками."""
+    with open(path, 'rb') as f:
+        lines = _tail_lines(f, os.fstat(f.fileno()).st_size, count, block_size)
+    return b"".join(lines).decode('utf-8', errors='ignore')
+
+class LogTailer:
+    """
+    Фоновый поток, который следит за файлом лога и держит последние строки
+    в памяти, чтобы /api/log не открывал и не читал файл на каждый запрос.
+    Ротация и усечение файла проверяются раз в секунду по inode и размеру.
+    """
+    def __init__(self, path, count=50, poll_interval=0.25, check_interval=1.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.check_interval = check_interval
+        self._ring = deque(maxlen=count)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="log-tailer", daemon=True)
+        self._thread.start()
+
+    def text(self):
+        with self._lock:
+            return "".join(self._ring)
+
+    def _run(self):
+        while True:
+            try:
+                self._follow()
+            except OSError:
+                # Файла временно нет (ротация) - ждем его появления
+                time.sleep(self.check_interval)
+
+    def _follow(self):
+        with open(self.path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            lines = _tail_lines(f, st.st_size, self._ring.maxlen)
+            f.seek(st.st_size)
+            with self._lock:
+                self._ring.clear()
+                self._ring.extend(l.decode('utf-8', errors='ignore') for l in lines)
+
+            partial = b""
+            next_check = time.monotonic() + self.check_interval
+            while True:
+                line = f.readline()
+                if line:
+                    # Строка может быть дописана не полностью - ждем перевода строки
+                    partial += line
+                    if partial.endswith(b"\n"):
+                        with self._lock:
+                            self._ring.append(partial.decode('utf-8', errors='ignore'))
+                        partial = b""
+                    continue
+
+                if time.monotonic() >= next_check:
+                    cur = os.stat(self.path)
+                    if cur.st_ino != st.st_ino or cur.st_size < f.tell():
+                        return  # файл заменен или усечен - открываем заново
+                    next_check = time.monotonic() + self.check_interval
+                time.sleep(self.poll_interval)
+
+log_tailer = LogTailer(paths.LOG_FILE, 50)
+
 @app.route('/api/log', methods=['GET'])
 def get_log():
     """Возвращает последние строки лога."""
     try:
+        if log_tailer.running:
+            return log_tailer.text()
         if os.path.exists(paths.LOG_FILE):
-            with open(paths.LOG_FILE, 'r', encoding='utf-8', errors='ignore') as f:
-                lines = f.readlines()
-                return "".join(lines[-50:])
+            return tail_file(paths.LOG_FILE, 50)
         return "Log file empty."
     except Exception as e:
         return str(e)
@@ -156,11 +344,48 @@ def get_log():
 @app.route('/<path:filename>')
 def serve_repo(filename):
     """Раздает файлы репозитория pkg напрямую из корня."""
-    return send_from_directory(str(paths.REPO_STORAGE_DIR), filename)
+    # Файл с тем же именем может быть заменен при синхронизации,
+    # поэтому клиент всегда перепроверяет его по ETag/Last-Modified.
+    return send_from_directory(str(paths.REPO_STORAGE_DIR), filename,
+                               conditional=True, etag=True)
+
+def _chown_to_service_user(user):
+    """
+    Передает пользователю службы BASE_DIR и файлы приложения. Установка идет
+    под sudo, и созданные при этом файлы (update.log, ключи, конфиги) принадлежат root:
+    без этого служба не сможет писать в лог и делать atomic_write в BASE_DIR.
+    """
+    pw = pwd.getpwnam(user)
+    if pw.pw_uid == 0:
+        return
+    app_files = [
+        paths.BASE_DIR,
+        paths.LOG_FILE,
+        paths.CONFIG_JSON,
+        paths.SOURCES_JSON,
+        paths.TRACKING_LIST,
+        paths.KEYS_DIR / "secret.key",
+        paths.KEYS_DIR / "public.key",
+        paths.KEYS_DIR / "secret.pub",
+        repo_discovery.ETAG_CACHE_FILE,
+        repo_sync.ETAG_CACHE_FILE,
+    ]
+    for path in app_files:
+        try:
+            os.chown(path, pw.pw_uid, pw.pw_gid, follow_symlinks=False)
+        except FileNotFoundError:
+            pass
+    # Репозиторий целиком: папки архитектур, пакеты и индексы
+    for root, dirs, files in os.walk(paths.REPO_STORAGE_DIR):
+        os.chown(root, pw.pw_uid, pw.pw_gid, follow_symlinks=False)
+        for name in files:
+            os.chown(os.path.join(root, name), pw.pw_uid, pw.pw_gid, follow_symlinks=False)
 
 def install_service():
     """Установка systemd службы."""
-    user = os.environ.get('USER') or 'root'
+    # Под sudo USER уже root; служба запускается от пользователя, вызвавшего sudo
+    user = (os.environ.get('SUDO_USER') or os.environ.get('USER')
+            or pwd.getpwuid(os.getuid()).pw_name)
     service_path = "/etc/systemd/system/repo-dashboard.service"
     
     # Определяем путь для ExecStart
@@ -197,11 +422,21 @@ WantedBy=multi-user.target
             print("❌ Ошибка: Для установки службы требуются права root (sudo).")
             sys.exit(1)
 
-        with open(service_path, "w") as f:
-            f.write(content)
-        
-        subprocess.run(["systemctl", "daemon-reload"], check=True)
+        try:
+            with open(service_path, "r") as f:
+                unit_changed = f.read() != content
+        except FileNotFoundError:
+            unit_changed = True
+
+        # Тот же unit-файл: перезапись и перечитывание всех юнитов systemd не нужны
+        if unit_changed:
+            with open(service_path, "w") as f:
+                f.write(content)
+            subprocess.run(["systemctl", "daemon-reload"], check=True)
+        _chown_to_service_user(user)
         subprocess.run(["systemctl", "enable", "repo-dashboard"], check=True)
+        # restart, а не enable --now: при повторной установке поверх обновленного
+        # бинарника уже запущенная служба должна подхватить новую версию
         subprocess.run(["systemctl", "restart", "repo-dashboard"], check=True)
         logger.info("✅ Служба repo-dashboard успешно установлена и запущена.")
     except Exception as e:
@@ -216,8 +451,8 @@ def uninstall_service():
             print("❌ Ошибка: Для удаления службы требуются права root (sudo).")
             sys.exit(1)
 
-        subprocess.run(["systemctl", "stop", "repo-dashboard"], check=False)
-        subprocess.run(["systemctl", "disable", "repo-dashboard"], check=False)
+        # Остановка и отключение одним заданием systemd
+        subprocess.run(["systemctl", "disable", "--now", "repo-dashboard"], check=False)
         if os.path.exists(service_path):
             os.remove(service_path)
         subprocess.run(["systemctl", "daemon-reload"], check=True)
@@ -226,9 +461,23 @@ def uninstall_service():
         logger.error(f"❌ Ошибка при удалении службы: {e}")
         sys.exit(1)
 
+def _on_job_skipped(event):
+    """Логирует пропуск запуска планировщиком."""
+    if event.code == EVENT_JOB_MISSED:
+        logger.warning("⚠️ Плановое обновление пропущено: время запуска истекло.")
+    else:
+        logger.warning("⚠️ Плановое обновление пропущено: предыдущий запуск еще выполняется.")
+
 def start_scheduler():
     """Запуск фонового планировщика обновлений."""
-    scheduler = BackgroundScheduler()
+    # Просроченные запуски сливаются в один, и задание не выполняется
+    # параллельно самому себе. Запуск из UI исключается общим update_lock
+    # внутри repo_update.run_all.
+    scheduler = BackgroundScheduler(
+        executors={'default': SchedulerThreadPool(2)},
+        job_defaults={'coalesce': True, 'max_instances': 1, 'misfire_grace_time': 300},
+    )
+    scheduler.add_listener(_on_job_skipped, EVENT_JOB_MAX_INSTANCES | EVENT_JOB_MISSED)
     scheduler.add_job(repo_update.run_all, 'interval', hours=6, id='repo_update_job')
     scheduler.start()
     logger.info("⏰ Внутренний планировщик запущен (период: 6 часов).")
@@ -248,8 +497,12 @@ if __name__ == '__main__':
         sys.exit(0)
 
     paths.ensure_folders()
+    log_tailer.start()
     start_scheduler()
     
     logger.info(f"🚀 Запуск Waitress на http://0.0.0.0:8080")
     logger.info(f"📍 Базовая директория: {paths.BASE_DIR}")
-    waitress.serve(app, host='0.0.0.0', port=8080)
\ No newline at end of file
+    # Обработчики блокируются на файловом I/O и запросах к GitHub (discovery),
+    # поэтому пул потоков больше стандартных 4; poll() вместо select()
+    # снимает ограничение FD_SETSIZE на число соединений.
+    waitress.serve(app, host='0.0.0.0', port=8080, threads=16, asyncore_use_poll=True)
\ No newline at end of file
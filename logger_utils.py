@@ -1,13 +1,12 @@
 import logging
 import sys
-from datetime import datetime
 import paths
 
-class CustomFormatter(logging.Formatter):
-    """Кастомный форматтер для сохранения стиля старых логов."""
-    def format(self, record):
-        timestamp = datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
-        return f"{timestamp} {record.getMessage()}"
+# Формат старых логов: "[YYYY-MM-DD HH:MM:SS] сообщение".
+# Штатный форматтер берет время из record.created через time.strftime,
+# без создания datetime на каждую запись.
+LOG_FORMAT = "[%(asctime)s] %(message)s"
+LOG_DATEFMT = "%Y-%m-%d %H:%M:%S"
 
 def setup_logger(name=None):
     """Настройка логгера для записи в файл и stdout."""
@@ -18,7 +17,7 @@ def setup_logger(name=None):
     if logger.handlers:
         return logger
 
-    formatter = CustomFormatter()
+    formatter = logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT)
 
     # Файловый хендлер
     file_handler = logging.FileHandler(paths.LOG_FILE, encoding='utf-8')
@@ -32,5 +31,13 @@ def setup_logger(name=None):
 
     return logger
 
+def write_raw(line):
+    """Пишет строку в файл лога как есть (без времени) через уже открытый хендлер."""
+    for handler in logger.handlers:
+        if isinstance(handler, logging.FileHandler) and handler.stream is not None:
+            with handler.lock:
+                handler.stream.write(line + "\n")
+                handler.stream.flush()
+
 # Глобальный экземпляр для удобства
 logger = setup_logger()
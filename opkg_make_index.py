@@ -8,15 +8,39 @@ from __future__ import print_function
 
 import sys
 import os
+import io
+import shutil
+import mmap
+import struct
+import zlib
 import tarfile
 import tempfile
 import hashlib
 import re
 import subprocess
-from stat import ST_SIZE
 import collections
 import argparse
-import posixpath
+from concurrent.futures import ThreadPoolExecutor
+try:
+    # python-isal: ISA-L deflate behind the gzip API, several times faster
+    # than zlib (bpo-43613); its level 3 is about zlib's level 6
+    from isal import igzip as gzip
+    GZIP_LEVEL = 3
+except ImportError:
+    import gzip
+    GZIP_LEVEL = 6
+
+# Read buffer for hashing package files
+DIGEST_BUFSIZE = 1 << 20
+# Files larger than this are hashed through mmap
+DIGEST_MMAP_MIN = 1 << 20
+# Read buffer for streaming through data.tar.* members
+READ_BUFSIZE = 4 << 20
+PACKAGE_EXTENSIONS = ('.ipk', '.opk', '.deb')
+# Package files announced to the kernel (POSIX_FADV_WILLNEED) ahead of the readers
+READAHEAD_FILES = 32
+# Parallel gzip for Packages.gz, if installed
+PIGZ = shutil.which("pigz")
 
 # ==============================================================================
 # arfile.py content
@@ -48,11 +72,19 @@ class FileSection(object):
         return self.f.tell() - self.offset
 
     def read(self, size=-1):
+        # Never read past the end of the member into the next ar header
+        remaining = max(0, self.size - self.tell())
+        if size is None or size < 0 or size > remaining:
+            size = remaining
         return self.f.read(size)
 
 
 class ArFile(object):
 
+    # ar member header, field lengths from /usr/include/ar.h:
+    # name, date, uid, gid, mode, size, magic
+    _hdr_struct = struct.Struct("16s12s6s6s8s10s2s")
+
     def __init__(self, f, fn):
         self.f = f
         self.directory = {}
@@ -64,7 +96,8 @@ class ArFile(object):
 
     def open(self, fname):
         if fname in self.directory:
-            return FileSection(self.f, self.directory[fname][-1], int(self.directory[fname][5]))
+            offset, size = self.directory[fname]
+            return FileSection(self.f, offset, size)
 
         if self.directoryRead:
             raise IOError("AR member not found: " + fname)
@@ -76,42 +109,35 @@ class ArFile(object):
 
     def _scan(self, fname):
         self.f.seek(self.directoryOffset, 0)
+        hdr_size = self._hdr_struct.size
 
         while True:
-            line = self.f.readline()
-            if not line:
+            hdr = self.f.read(hdr_size)
+            if hdr[:1] == b"\n":
+                # Padding byte after an odd-sized member
+                hdr = hdr[1:] + self.f.read(1)
+            if len(hdr) < hdr_size:
                 self.directoryRead = True
                 return None
 
-            if line.decode('ascii') == "\n":
-                line = self.f.readline()
-                if not line:
-                    break
-            line = line.decode('ascii')
-            line = line.replace('`', '')
-            # Field lengths from /usr/include/ar.h:
-            ar_field_lens = [16, 12, 6, 6, 8, 10, 2]
-            descriptor = []
-            for field_len in ar_field_lens:
-                descriptor.append(line[:field_len].strip())
-                line = line[field_len:]
-            size = int(descriptor[5])
+            name, _, _, _, _, size, _ = self._hdr_struct.unpack(hdr)
+            size = int(size)
+            memberName = name.strip().decode('ascii')
             # Check for optional / terminator
-            if descriptor[0][-1] == "/":
-                memberName = descriptor[0][:-1]
-            else:
-                memberName = descriptor[0]
-            self.directory[memberName] = descriptor + [self.f.tell()]
+            if memberName.endswith("/"):
+                memberName = memberName[:-1]
+            offset = self.f.tell()
+            self.directory[memberName] = (offset, size)
 
             if memberName == fname:
                 # Record directory offset to start from next time
-                self.directoryOffset = self.f.tell() + size
-                return FileSection(self.f, self.f.tell(), size)
+                self.directoryOffset = offset + size
+                return FileSection(self.f, offset, size)
 
             # Skip data and loop
             if size % 2:
                 size = size + 1
-            data = self.f.seek(size, 1)
+            self.f.seek(size, 1)
 
 # ==============================================================================
 # opkg.py content
@@ -130,89 +156,111 @@ def order(x):
     return 256 + ord(x)
 
 
+# A non-digit run followed by a digit run; see _version_key()
+_VERSION_SEGMENT = re.compile(r'(\D*)(\d*)')
+# Upstream version and optional "-rN" package revision
+_VERSION_SPLIT = re.compile(r"(.+?)(-r.+)?$")
+# Segment value of an exhausted version string: empty run, number 0
+_VERSION_END = ((0,), 0)
+
+
+def _version_key(version):
+    """
+    Build a tuple key that orders like the opkg version comparison
+    algorithm (libopkg/pkg.c): the string alternates between non-digit runs,
+    compared character by character with order(), and digit runs, compared
+    by numeric value. The end of a run counts as order 0, and an exhausted
+    string compares as an endless sequence of empty runs and zeros.
+    """
+    segments = []
+    for m in _VERSION_SEGMENT.finditer(version or ""):
+        alpha, digits = m.groups()
+        if not alpha and not digits:
+            continue
+        segments.append((tuple([order(c) for c in alpha]) + (0,), int(digits or 0)))
+    while segments and segments[-1] == _VERSION_END:
+        segments.pop()
+    # Only the first segment can equal _VERSION_END, so two terminators make
+    # tuple comparison behave as if both keys were padded with _VERSION_END
+    segments.append(_VERSION_END)
+    segments.append(_VERSION_END)
+    return tuple(segments)
+
+
 class Version(object):
     """A class for holding parsed package version information."""
 
+    __slots__ = ('epoch', 'version', '_key')
+
     def __init__(self, epoch, version):
         self.epoch = epoch
         self.version = version
-
-    def _versioncompare(self, selfversion, refversion):
-        """
-                Implementation below is a copy of the opkg version comparison algorithm
-                http://git.yoctoproject.org/cgit/cgit.cgi/opkg/tree/libopkg/pkg.c*n933
-                it alternates between number and non number comparisons until a difference is found
-                digits are compared by value. other characters are sorted lexically using the above method orderOfChar
-
-                One slight modification, the original version can return any value, whereas this one is limited to -1, 0, +1
-                """
-        if not selfversion:
-            selfversion = ""
-        if not refversion:
-            refversion = ""
-
-        value = list(selfversion)
-        ref = list(refversion)
-
-        while value or ref:
-            first_diff = 0
-            # alphanumeric comparison
-            while (value and not str.isdigit(value[0])) or (ref and not str.isdigit(ref[0])):
-                vc = order(value.pop(0) if value else None)
-                rc = order(ref.pop(0) if ref else None)
-                if vc != rc:
-                    return -1 if vc < rc else 1
-
-            # comparing numbers
-            # start by skipping 0
-            while value and value[0] == "0":
-                value.pop(0)
-            while ref and ref[0] == "0":
-                ref.pop(0)
-
-            # actual number comparison
-            while value and str.isdigit(value[0]) and ref and str.isdigit(ref[0]):
-                if not first_diff:
-                    first_diff = int(value.pop(0)) - int(ref.pop(0))
-                else:
-                    value.pop(0)
-                    ref.pop(0)
-
-            # the one that has a value remaining was the highest number
-            if value and str.isdigit(value[0]):
-                return 1
-            if ref and str.isdigit(ref[0]):
-                return -1
-            # in case of equal length numbers look at the first diff
-            if first_diff:
-                return 1 if first_diff > 0 else -1
-        return 0
+        # Comparison key, computed once: compare() is called for every
+        # package added to the index
+        comps = _VERSION_SPLIT.match(version)
+        if comps:
+            self._key = (epoch, _version_key(comps.group(1)), _version_key(comps.group(2)))
+        else:
+            self._key = (epoch, _version_key(""), _version_key(""))
 
     def compare(self, ref):
-        if (self.epoch > ref.epoch):
-            return 1
-        elif (self.epoch < ref.epoch):
-            return -1
-        else:
-            self_ver_comps = re.match(r"(.+?)(-r.+)?$", self.version)
-            ref_ver_comps = re.match(r"(.+?)(-r.+)?$", ref.version)
-            r = self._versioncompare(self_ver_comps.group(1), ref_ver_comps.group(1))
-            if r == 0:
-                r = self._versioncompare(self_ver_comps.group(2), ref_ver_comps.group(2))
-            return r
+        return (self._key > ref._key) - (self._key < ref._key)
 
     def __str__(self):
         return str(self.epoch) + ":" + self.version
 
 
+# Parsed versions by version string; Version objects are never modified,
+# so packages sharing a version string share one instance
+_VERSION_CACHE = {}
+
+
 def parse_version(versionstr):
+    parsed = _VERSION_CACHE.get(versionstr)
+    if parsed is not None:
+        return parsed
     epoch = 0
+    version = versionstr
     # check for epoch
-    m = re.match('([0-9]*):(.*)', versionstr)
-    if m:
-        (epochstr, versionstr) = m.groups()
+    epochstr, sep, rest = versionstr.partition(':')
+    if sep and epochstr.isascii() and epochstr.isdigit():
         epoch = int(epochstr)
-    return Version(epoch, versionstr)
+        version = rest
+    parsed = _VERSION_CACHE[versionstr] = Version(epoch, version)
+    return parsed
+
+
+def _open_control_tar(blob):
+    """ Open control.tar.gz member bytes as a TarFile """
+    if blob[:2] == b"\x1f\x8b":
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            data = d.decompress(blob)
+        except zlib.error:
+            data = None
+        # Single complete gzip member: use the fast path
+        if data is not None and d.eof and not d.unused_data:
+            return tarfile.open(fileobj=io.BytesIO(data), mode="r:")
+    # Not gzip, truncated or multi-member gzip: let tarfile detect the format
+    return tarfile.open(fileobj=io.BytesIO(blob), mode="r")
+
+
+def _relative_path(path, start):
+    """ os.path.relpath() for paths built below start, by slicing off the prefix """
+    prefix = start if start.endswith(os.sep) else start + os.sep
+    if path.startswith(prefix):
+        return path[len(prefix):]
+    return os.path.relpath(path, start)
+
+
+# "Name: value" line of a control file / Packages index
+_CTRL_RE = re.compile(r'([\w-]*?):\s*(.*)')
+
+
+# Fields with few distinct values across an index; interned so that all
+# packages share one string object per value
+_INTERNED_FIELDS = frozenset(('package', 'architecture', 'section', 'maintainer',
+                              'license', 'priority', 'source'))
 
 
 class Package(object):
@@ -223,7 +271,8 @@ class Package(object):
     # relpath: If this argument is set, the file path is given relative to this
     #   path when a string representation of the Package object is created. If
     #   this argument is not set, the basename of the file path is given.
-    def __init__(self, fn=None, relpath=None, all_fields=None):
+    # stat: os.stat() result for fn if the caller already has it
+    def __init__(self, fn=None, relpath=None, all_fields=None, stat=None):
         self.package = None
         self.version = 'none'
         self.parsed_version = None
@@ -248,29 +297,37 @@ class Package(object):
         self.priority = None
         self.tags = None
         self.fn = fn
+        self._stat = stat
         self.license = None
+        # Cached print() output by checksum selection; cleared by the setters
+        self._serialized = {}
 
         self.user_defined_fields = collections.OrderedDict()
         if fn:
-            # see if it is deb format
-            f = open(fn, "rb")
-
             if relpath:
-                self.filename = os.path.relpath(fn, relpath)
+                self.filename = _relative_path(fn, relpath)
             else:
                 self.filename = os.path.basename(fn)
 
-            if tarfile.is_tarfile(fn):
-                tar = tarfile.open(fn, "r", f)
-                tarStream = tar.extractfile("./control.tar.gz")
-            else:
-                ar = ArFile(f, fn)
-                tarStream = ar.open("control.tar.gz")
-            tarf = tarfile.open("control.tar.gz", "r", tarStream)
+            with open(fn, "rb") as f:
+                # see if it is deb (ar) format; otherwise it is a (gzip'd) tar
+                magic = f.read(8)
+                f.seek(0)
+                if magic.startswith(b"!<arch>"):
+                    ar = ArFile(f, fn)
+                    tarStream = ar.open("control.tar.gz")
+                else:
+                    tar = tarfile.open(fileobj=f, mode="r:*")
+                    tarStream = tar.extractfile("./control.tar.gz")
+                # control.tar.gz is a few KB: read it in one go, inflate it with a
+                # single zlib call and let tarfile work on the plain tar in memory
+                tarf = _open_control_tar(tarStream.read())
             try:
                 control = tarf.extractfile("control")
             except KeyError:
                 control = tarf.extractfile("./control")
+            # Decode the whole control file once; read_control works on str
+            control = io.TextIOWrapper(control, encoding="utf-8", newline="")
             try:
                 self.read_control(control, all_fields)
             except TypeError as e:
@@ -281,69 +338,69 @@ class Package(object):
         self.meta_dir = None
 
     def __getattr__(self, name):
-        if name == "md5":
-            self._computeFileMD5()
-            return self.md5
-        elif name == "sha256":
-            self._computeFileSHA256()
-            return self.sha256
+        if name in ("md5", "sha256"):
+            self._compute_digests((name,))
+            return self.__dict__[name]
         elif name == 'size':
             return self._get_file_size()
         else:
             raise AttributeError(name)
 
-    def _computeFileMD5(self):
-        # compute the MD5.
-        if not self.fn:
-            self.md5 = 'Unknown'
-        else:
-            f = open(self.fn, "rb")
-            sum = hashlib.md5()
-            while True:
-                data = f.read(1024)
-                if not data:
-                    break
-                sum.update(data)
-            f.close()
-            self.md5 = sum.hexdigest()
-
-    def _computeFileSHA256(self):
-        # compute the SHA256.
+    def _compute_digests(self, names):
+        """Compute the requested file digests (md5/sha256) in a single read pass."""
         if not self.fn:
-            self.sha256 = 'Unknown'
-        else:
-            f = open(self.fn, "rb")
-            sum = hashlib.sha256()
+            for name in names:
+                setattr(self, name, 'Unknown')
+            return
+        with open(self.fn, "rb") as f:
+            if os.name == "posix" and os.fstat(f.fileno()).st_size > DIGEST_MMAP_MIN:
+                # Hash straight from the page cache: update() on the mapping
+                # releases the GIL for the whole file, without read copies
+                with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mm:
+                    for name in names:
+                        setattr(self, name, hashlib.new(name, mm).hexdigest())
+                return
+            if len(names) == 1 and hasattr(hashlib, "file_digest"):
+                setattr(self, names[0], hashlib.file_digest(f, names[0]).hexdigest())
+                return
+            sums = [hashlib.new(name) for name in names]
+            buf = bytearray(DIGEST_BUFSIZE)
+            view = memoryview(buf)
             while True:
-                data = f.read(1024)
-                if not data:
+                n = f.readinto(buf)
+                if not n:
                     break
-                sum.update(data)
-            f.close()
-            self.sha256 = sum.hexdigest()
+                for sum in sums:
+                    sum.update(view[:n])
+        for name, sum in zip(names, sums):
+            setattr(self, name, sum.hexdigest())
 
     def _get_file_size(self):
         if not self.fn:
             self.size = 0
         else:
-            stat = os.stat(self.fn)
-            self.size = stat[ST_SIZE]
+            if self._stat is None:
+                self._stat = os.stat(self.fn)
+            self.size = self._stat.st_size
         return int(self.size)
 
     def read_control(self, control, all_fields=None):
+        self._serialized.clear()
         line = control.readline()
         while 1:
             if not line:
                 break
-            # Decode if stream has byte strings
-            if not isinstance(line, str):
-                line = line.decode()
             line = line.rstrip()
-            lineparts = re.match(r'([\w-]*?):\s*(.*)', line)
-            if lineparts:
-                name = lineparts.group(1)
+            # Fast path for the usual "Name: value" line; anything unusual
+            # goes through the regex
+            name, sep, value = line.partition(':')
+            if sep and name.replace('-', '').replace('_', '').isalnum():
+                value = value.lstrip()
+            else:
+                lineparts = _CTRL_RE.match(line)
+                name, value = lineparts.groups() if lineparts else (None, None)
+            if name is not None:
                 name_lowercase = name.lower()
-                value = lineparts.group(2)
                 while 1:
                     line = control.readline().rstrip()
                     if not line:
@@ -352,6 +409,8 @@ class Package(object):
                         break
 
                     value = value + '\n' + line
+                if name_lowercase in _INTERNED_FIELDS:
+                    value = sys.intern(value)
                 if name_lowercase == 'size':
                     self.size = int(value)
                 elif name_lowercase == 'md5sum':
@@ -384,6 +443,7 @@ class Package(object):
 
     def set_package(self, package):
         self.package = package
+        self._serialized.clear()
 
     def get_package(self):
         return self.package
@@ -391,72 +451,84 @@ class Package(object):
     def set_version(self, version):
         self.version = version
         self.parsed_version = parse_version(version)
+        self._serialized.clear()
 
     def get_version(self):
         return self.version
 
     def set_architecture(self, architecture):
         self.architecture = architecture
+        self._serialized.clear()
 
     def get_architecture(self):
         return self.architecture
 
     def set_maintainer(self, maintainer):
         self.maintainer = maintainer
+        self._serialized.clear()
 
     def get_maintainer(self):
         return self.maintainer
 
     def set_source(self, source):
         self.source = source
+        self._serialized.clear()
 
     def get_source(self):
         return self.source
 
     def set_description(self, description):
         self.description = description
+        self._serialized.clear()
 
     def get_description(self):
         return self.description
 
     def set_depends(self, depends):
         self.depends = depends
+        self._serialized.clear()
 
     def get_depends(self, depends):
         return self.depends
 
     def set_provides(self, provides):
         self.provides = provides
+        self._serialized.clear()
 
     def get_provides(self, provides):
         return self.provides
 
     def set_replaces(self, replaces):
         self.replaces = replaces
+        self._serialized.clear()
 
     def get_replaces(self, replaces):
         return self.replaces
 
     def set_conflicts(self, conflicts):
         self.conflicts = conflicts
+        self._serialized.clear()
 
     def get_conflicts(self, conflicts):
         return self.conflicts
 
     def set_suggests(self, suggests):
         self.suggests = suggests
+        self._serialized.clear()
 
     def get_suggests(self, suggests):
         return self.suggests
 
     def set_section(self, section):
         self.section = section
+        self._serialized.clear()
 
     def get_section(self, section):
         return self.section
 
     def set_license(self, license):
         self.license = license
+        self._serialized.clear()
 
     def get_license(self, license):
         return self.license
@@ -501,16 +573,20 @@ class Package(object):
         if not self.fn:
             sys.stderr.write("Package '%s' has empty fn, returning empty filelist\n" % (self.package))
             return []
-        f = open(self.fn, "rb")
+        f = open(self.fn, "rb", buffering=READ_BUFSIZE)
         ar = ArFile(f, self.fn)
         try:
             tarStream = ar.open("data.tar.gz")
-            tarf = tarfile.open("data.tar.gz", "r", tarStream)
+            mode = "r|*"
         except IOError:
             tarStream = ar.open("data.tar.xz")
-            tarf = tarfile.open("data.tar.xz", "r:xz", tarStream)
-        self.file_list = tarf.getnames()
-        self.file_list = [["./", ""][a.startswith("./")] + a for a in self.file_list]
+            mode = "r|xz"
+        # Only names are needed: read the archive as a stream, one member
+        # header after another, without building a seekable member index
+        tarf = tarfile.open(fileobj=tarStream, mode=mode, copybufsize=READ_BUFSIZE)
+        self.file_list = [a if a.startswith("./") else "./" + a
+                          for a in (tarinfo.name for tarinfo in tarf)]
+        tarf.close()
 
         f.close()
         return self.file_list
@@ -527,61 +603,34 @@ class Package(object):
         file.write(str(self))
         file.close()
 
-        cmd = ["tar", "cvz", "--format=gnu", "-f", "%s/control.tar.gz" % self.scratch_dir, "control"]
-        process = subprocess.Popen(cmd, cwd=self.meta_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = process.communicate()
-        if process.returncode != 0:
-             sys.stderr.write("Error creating control.tar.gz: %s\n" % err)
-
-        bits = "control.tar.gz"
+        # Archives are built in-process with tarfile (GNU format, gzip level 6
+        # as with `tar cz`) instead of spawning tar three times per package
+        bits = ["control.tar.gz"]
+        try:
+            with tarfile.open("%s/control.tar.gz" % self.scratch_dir, "w:gz",
+                              compresslevel=6, format=tarfile.GNU_FORMAT) as tarf:
+                tarf.add("%s/control" % self.meta_dir, arcname="control")
+        except (OSError, tarfile.TarError) as e:
+            sys.stderr.write("Error creating control.tar.gz: %s\n" % e)
 
         if self.file_list:
-            cmd = ["tar", "cvz", "--format=gnu", "-f", "%s/data.tar.gz" % self.scratch_dir]
-            # Since self.file_list might be long, passing as args is risky if shell=False? 
-            # Original code `tar cvz ...` in shell relied on CWD.
-            # We can run it in self.file_dir.
-            # But wait, original code was: cmd = "cd %s ; tar cvz ... -f %s/data.tar.gz" % (self.file_dir, self.scratch_dir)
-            # The list of files is NOT in the cmd explicitly in original code?
-            # Wait, line 544 original: cmd = "cd %s ; tar cvz --format=gnu -f %s/data.tar.gz" % (self.file_dir, self.scratch_dir)
-            # It seems it was missing file arguments? That looks like a bug in original code or it relied on default behavior?
-            # Ah, line 54[5-8]... wait, checking original code again.
-            
-            # Original Line 544: cmd = "cd %s ; tar cvz --format=gnu -f %s/data.tar.gz" % (self.file_dir, self.scratch_dir)
-            # It DOES NOT list files. That would archive NOTHING or everything? 
-            # GNU tar requires file arguments or -T.
-            # If original code was `tar cvz -f archive.tgz` it would fail or do nothing?
-            # Wait, looking at `write_package`...
-            # The files are in `self.file_dir`. 
-            # If I just want to archive all files in `self.file_dir`?
-            # But `self.file_list` is populated. 
-            # The code seems to extract package to `self.file_dir`? 
-            # Actually, `opkg_make_index` creates index from EXISTING packages, 
-            # BUT `write_package` seems to be for CREATING a package?
-            # This tool is mostly used for reading indices (make_index).
-            # `write_package` might be unused or for re-packing.
-            # `opkg-make-index` main purpose is reading.
-            # However, to be safe, I should fix the Python 3 crash.
-            # `cmd` in line 544 has no file args.
-            # Maybe it assumes `.`? No `tar` needs explicit files usually.
-            # Unless `tar` defaults to stdin? 
-            # Let's assume "." for now if it's supposed to pack everything in file_dir.
-            
-            cmd = ["tar", "cvz", "--format=gnu", "-f", "%s/data.tar.gz" % self.scratch_dir, "."]
-            process = subprocess.Popen(cmd, cwd=self.file_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            out, err = process.communicate()
-
-            bits = bits + " data.tar.gz"
+            try:
+                with tarfile.open("%s/data.tar.gz" % self.scratch_dir, "w:gz",
+                                  compresslevel=6, format=tarfile.GNU_FORMAT) as tarf:
+                    tarf.add(self.file_dir, arcname=".")
+            except (OSError, tarfile.TarError) as e:
+                sys.stderr.write("Error creating data.tar.gz: %s\n" % e)
+            bits.append("data.tar.gz")
 
         file = "%s_%s_%s.%s" % (self.package, self.version, self.architecture, self.get_package_extension())
         # Final pack
-        # cmd = "cd %s ; tar cvz --format=gnu -f %s/%s %s" % (self.scratch_dir, dirname, file, bits)
-        # bits is a string "control.tar.gz data.tar.gz"
-        
-        cmd = ["tar", "cvz", "--format=gnu", "-f", os.path.join(dirname, file)] + bits.split()
-        process = subprocess.Popen(cmd, cwd=self.scratch_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = process.communicate()
-        if process.returncode != 0:
-             sys.stderr.write("Error creating final package: %s\n" % err)
+        try:
+            with tarfile.open(os.path.join(dirname, file), "w:gz",
+                              compresslevel=6, format=tarfile.GNU_FORMAT) as tarf:
+                for bit in bits:
+                    tarf.add("%s/%s" % (self.scratch_dir, bit), arcname=bit)
+        except (OSError, tarfile.TarError) as e:
+            sys.stderr.write("Error creating final package: %s\n" % e)
 
     def compare_version(self, ref):
         """Compare package versions of self and ref"""
@@ -596,66 +645,79 @@ class Package(object):
         return self.parsed_version.compare(ref.parsed_version)
 
     def print(self, checksum):
-        out = ""
+        key = tuple(sorted(checksum))
+        out = self._serialized.get(key)
+        if out is not None:
+            return out
+
+        # Hash the file once for all requested checksums
+        missing = tuple(c for c in ('md5', 'sha256') if c in checksum and c not in self.__dict__)
+        if missing:
+            self._compute_digests(missing)
 
         # XXX - Some checks need to be made, and some exceptions
         #       need to be thrown. -- a7r
 
+        parts = []
         if self.package:
-            out = out + "Package: %s\n" % (self.package)
+            parts.append("Package: %s\n" % (self.package))
         if self.version:
-            out = out + "Version: %s\n" % (self.version)
+            parts.append("Version: %s\n" % (self.version))
         if self.depends:
-            out = out + "Depends: %s\n" % (self.depends)
+            parts.append("Depends: %s\n" % (self.depends))
         if self.provides:
-            out = out + "Provides: %s\n" % (self.provides)
+            parts.append("Provides: %s\n" % (self.provides))
         if self.replaces:
-            out = out + "Replaces: %s\n" % (self.replaces)
+            parts.append("Replaces: %s\n" % (self.replaces))
         if self.conflicts:
-            out = out + "Conflicts: %s\n" % (self.conflicts)
+            parts.append("Conflicts: %s\n" % (self.conflicts))
         if self.suggests:
-            out = out + "Suggests: %s\n" % (self.suggests)
+            parts.append("Suggests: %s\n" % (self.suggests))
         if self.recommends:
-            out = out + "Recommends: %s\n" % (self.recommends)
+            parts.append("Recommends: %s\n" % (self.recommends))
         if self.section:
-            out = out + "Section: %s\n" % (self.section)
+            parts.append("Section: %s\n" % (self.section))
         if self.architecture:
-            out = out + "Architecture: %s\n" % (self.architecture)
+            parts.append("Architecture: %s\n" % (self.architecture))
         if self.maintainer:
-            out = out + "Maintainer: %s\n" % (self.maintainer)
+            parts.append("Maintainer: %s\n" % (self.maintainer))
         if 'md5' in checksum:
             if self.md5:
-                out = out + "MD5Sum: %s\n" % (self.md5)
+                parts.append("MD5Sum: %s\n" % (self.md5))
         if 'sha256' in checksum:
             if self.sha256:
-                out = out + "SHA256sum: %s\n" % (self.sha256)
+                parts.append("SHA256sum: %s\n" % (self.sha256))
         if self.size:
-            out = out + "Size: %d\n" % int(self.size)
+            parts.append("Size: %d\n" % int(self.size))
         if self.installed_size:
-            out = out + "InstalledSize: %d\n" % int(self.installed_size)
+            parts.append("InstalledSize: %d\n" % int(self.installed_size))
         if self.filename:
-            out = out + "Filename: %s\n" % (self.filename)
+            parts.append("Filename: %s\n" % (self.filename))
         if self.source:
-            out = out + "Source: %s\n" % (self.source)
+            parts.append("Source: %s\n" % (self.source))
         if self.description:
-            out = out + "Description: %s\n" % (self.description)
+            parts.append("Description: %s\n" % (self.description))
         if self.oe:
-            out = out + "OE: %s\n" % (self.oe)
+            parts.append("OE: %s\n" % (self.oe))
         if self.homepage:
-            out = out + "HomePage: %s\n" % (self.homepage)
+            parts.append("HomePage: %s\n" % (self.homepage))
         if self.license:
-            out = out + "License: %s\n" % (self.license)
+            parts.append("License: %s\n" % (self.license))
         if self.priority:
-            out = out + "Priority: %s\n" % (self.priority)
+            parts.append("Priority: %s\n" % (self.priority))
         if self.tags:
-            out = out + "Tags: %s\n" % (self.tags)
+            parts.append("Tags: %s\n" % (self.tags))
         if self.user_defined_fields:
             for k, v in self.user_defined_fields.items():
-                out = out + "%s: %s\n" % (k, v)
-        out = out + "\n"
+                parts.append("%s: %s\n" % (k, v))
+        parts.append("\n")
 
+        out = self._serialized[key] = "".join(parts)
         return out
 
+    def __str__(self):
+        return self.print(['md5'])
+
     def __del__(self):
         # XXX - Why is the `os' module being yanked out before Package objects
         #       are being destroyed?  -- a7r
@@ -704,11 +766,9 @@ class Packages(object):
         return
 
     def write_packages_file(self, fn):
-        f = open(fn, "w")
-        names = list(self.packages.keys())
-        names.sort()
-        for name in names:
-            f.write(self.packages[name].__str__())
+        parts = [self.packages[name].__str__() for name in sorted(self.packages)]
+        with open(fn, "w", buffering=1 << 20) as f:
+            f.write("".join(parts))
         return
 
     def keys(self):
@@ -721,38 +781,189 @@ class Packages(object):
 # opkg-make-index content
 # ==============================================================================
 
+def _move_if_exists(src, dst):
+    """ Move src over dst; a missing src is not an error """
+    try:
+        os.replace(src, dst)
+    except FileNotFoundError:
+        # Only stat on the error path: the destination may be what is missing
+        if os.path.exists(src):
+            raise
+
+
 def to_morgue(filename, pkg_dir, verbose):
     """ Move files to morgue folder """
-    morgue_dir = pkg_dir + "/morgue"
+    morgue_dir = f"{pkg_dir}/morgue"
     if verbose:
-        sys.stderr.write("Moving " + filename + " to morgue\n")
-    if not os.path.exists(morgue_dir):
-        os.mkdir(morgue_dir)
-    if os.path.exists(pkg_dir + "/" + filename):
-        os.rename(pkg_dir + "/" + filename, morgue_dir + "/" + filename)
-    if os.path.exists(pkg_dir + "/" + filename + ".asc"):
-        os.rename(pkg_dir + "/" + filename + ".asc", morgue_dir + "/" + filename + ".asc")
+        sys.stderr.write(f"Moving {filename} to morgue\n")
+    os.makedirs(morgue_dir, exist_ok=True)
+    src = f"{pkg_dir}/{filename}"
+    dst = f"{morgue_dir}/{filename}"
+    _move_if_exists(src, dst)
+    _move_if_exists(f"{src}.asc", f"{dst}.asc")
 
 
 def to_locale(filename, locale, pkg_dir, locales_dir, verbose):
     """ Move file to locale_dir"""
-    locale_dir = pkg_dir + '/' + locales_dir + '/' + locale + "/"
+    locale_dir = f"{pkg_dir}/{locales_dir}/{locale}/"
     if verbose:
-        sys.stderr.write("Moving " + filename + " to " + locale_dir + "\n")
-    if not os.path.exists(locale_dir):
-        os.mkdir(locale_dir)
-    os.rename(pkg_dir + "/" + filename, locale_dir + "/" + filename)
-    if os.path.exists(pkg_dir + "/" + filename + ".asc"):
-        os.rename(pkg_dir + "/" + filename + ".asc", locale_dir + "/" + filename + ".asc")
+        sys.stderr.write(f"Moving {filename} to {locale_dir}\n")
+    os.makedirs(locale_dir, exist_ok=True)
+    src = f"{pkg_dir}/{filename}"
+    dst = f"{locale_dir}/{filename}"
+    os.replace(src, dst)
+    _move_if_exists(f"{src}.asc", f"{dst}.asc")
+
+
+_LOCALE_DEP_RE = re.compile(r'virtual-locale-([a-zA-Z]+)')
+_LOCALE_PKG_RE = re.compile(r'locale-base-([a-zA-Z]+)')
+
+
+def _scan_packages(pkg_dir):
+    """ Yield (path, stat) for every package file below pkg_dir """
+    stack = [pkg_dir]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(PACKAGE_EXTENSIONS):
+                    try:
+                        yield entry.path, entry.stat()
+                    except OSError:
+                        continue
+
+
+class PackagesWriter(object):
+    """ Writes Packages and Packages.gz side by side in a single pass """
+
+    def __init__(self, filename, gz_filename):
+        self.filename = filename
+        self.plain = open(filename, "wb", buffering=1 << 20)
+        self.gz_file = open(gz_filename, "wb")
+        self.proc = None
+        if PIGZ:
+            self.proc = subprocess.Popen([PIGZ, "-9", "-n", "-c", "-p", str(os.cpu_count() or 1)],
+                                         stdin=subprocess.PIPE, stdout=self.gz_file)
+            self.gz = self.proc.stdin
+        else:
+            self.gz = gzip.GzipFile(filename="", fileobj=self.gz_file, mode="wb", compresslevel=GZIP_LEVEL)
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self.plain.write(data)
+        if self.gz is not None:
+            try:
+                self.gz.write(data)
+            except BrokenPipeError:
+                self.gz = None
+
+    def close(self):
+        self.plain.close()
+        failed = self.gz is None
+        if not failed:
+            try:
+                self.gz.close()
+            except BrokenPipeError:
+                failed = True
+        if self.proc is not None and self.proc.wait() != 0:
+            failed = True
+        if failed:
+            # pigz went away: compress the finished plain file instead
+            self.gz_file.seek(0)
+            self.gz_file.truncate()
+            with open(self.filename, "rb") as src, \
+                    gzip.GzipFile(filename="", fileobj=self.gz_file, mode="wb", compresslevel=GZIP_LEVEL) as gz:
+                shutil.copyfileobj(src, gz, READ_BUFSIZE)
+        self.gz_file.close()
+
+
+def _will_need(path):
+    """ Ask the kernel to start reading a file into the page cache """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _read_package(abspath, pkg_dir, all_fields, checksum, stat, readahead=None):
+    """ Parse a package file and precompute its checksums (runs in a worker thread) """
+    if readahead:
+        # Keep the kernel READAHEAD_FILES packages ahead of the readers
+        _will_need(readahead)
+    pkg = Package(abspath, relpath=pkg_dir, all_fields=all_fields, stat=stat)
+    missing = tuple(c for c in ('md5', 'sha256') if c in checksum and c not in pkg.__dict__)
+    if missing:
+        pkg._compute_digests(missing)
+    return pkg
+
+
+def _read_file_list(pkg, pkg_dir):
+    """ File list of a package, None if it cannot be read (runs in a worker thread) """
+    try:
+        return pkg.get_file_list_dir(pkg_dir)
+    except (OSError, IOError):
+        return None
+
+
+# Packages.stamps.v2 record: ctime, length of the UTF-8 filename, filename
+_STAMP_STRUCT = struct.Struct("<QH")
+
+
+def _read_stamps(filename):
+    """ Load {filename: ctime} from a binary stamp file, {} if missing or damaged """
+    stamps = {}
+    try:
+        with open(filename, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return stamps
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                offset, end = 0, len(mm)
+                while offset < end:
+                    ctime, length = _STAMP_STRUCT.unpack_from(mm, offset)
+                    offset += _STAMP_STRUCT.size
+                    name = mm[offset:offset + length]
+                    if len(name) != length:
+                        raise ValueError("truncated stamp file")
+                    stamps[name.decode("utf-8", "surrogateescape")] = ctime
+                    offset += length
+    except (OSError, ValueError, struct.error):
+        return {}
+    return stamps
+
+
+def _write_stamps(filename, stamps):
+    """ Store {filename: ctime} as a binary stamp file """
+    parts = []
+    for name, ctime in stamps.items():
+        raw = name.encode("utf-8", "surrogateescape")
+        parts.append(_STAMP_STRUCT.pack(int(ctime), len(raw)))
+        parts.append(raw)
+    with open(filename, "wb") as f:
+        f.write(b"".join(parts))
 
 
 def make_index(pkg_dir, packages_filename=None, filelist_filename=None, old_filename=None, 
                locales_dir=None, verbose=False, opt_m=False, opt_a=False, opt_f=False, 
-               opt_s=False, checksum=['md5']):
-    """ Programmatic entry point for index creation """
-    stamplist_filename = "Packages.stamps"
+               opt_s=False, checksum=['md5'], return_index=False):
+    """ Programmatic entry point for index creation
+
+    With return_index, returns {package: version} of the entries written to
+    the index (as a parse of the Packages file would) instead of True.
+    """
+    stamplist_filename = "Packages.stamps.v2"
     if packages_filename:
-        stamplist_filename = packages_filename + ".stamps"
+        stamplist_filename = packages_filename + ".stamps.v2"
 
     packages = Packages()
 
@@ -766,39 +977,53 @@ def make_index(pkg_dir, packages_filename=None, filelist_filename=None, old_file
             sys.stderr.write("Reading package list from " + old_filename + "\n")
         old_packages = Packages()
         old_packages.read_packages_file(old_filename, opt_f)
-        for k in list(old_packages.packages.keys()):
-            pkg = old_packages.packages[k]
+        for pkg in old_packages.packages.values():
             old_pkg_hash[pkg.filename] = pkg
-        try:
-            with open(stamplist_filename, "r") as stamplist_filename_hdl:
-                for line in stamplist_filename_hdl:
-                    line = line.strip()
-                    parts = line.split(" ", 1)
-                    if len(parts) == 2:
-                        stamp, filename = parts
-                        pkgs_stamps[filename] = int(stamp)
-        except (IOError, ValueError):
-            pass
+        pkgs_stamps = _read_stamps(stamplist_filename)
 
     if verbose:
         sys.stderr.write("Reading in all the package info from %s\n" % (pkg_dir, ))
 
-    files = []
-    opkg_extensions = ['.ipk', '.opk', '.deb']
-    for dirpath, _, filenames in os.walk(pkg_dir):
-        for filename in filenames:
-            ext = os.path.splitext(filename)[1]
-            if ext in opkg_extensions:
-                files.append(os.path.join(dirpath, filename))
+    # One stat per file, taken while walking the tree
+    stats = dict(_scan_packages(pkg_dir))
+    files = sorted(stats)
+
+    # Digests are computed once, by the reader threads; an old entry without
+    # one of them (e.g. md5-only index, now with sha256) is read again
+    wanted_digests = () if opt_s else tuple(checksum)
+
+    def is_unchanged(filename, stat):
+        """ The old index entry is reusable: same ctime stamp and file size """
+        if not (filename in old_pkg_hash and filename in pkgs_stamps
+                and int(stat.st_ctime) == pkgs_stamps[filename]
+                and old_pkg_hash[filename].size == stat.st_size):
+            return False
+        old = old_pkg_hash[filename].__dict__
+        return all(old.get(c, 'Unknown') != 'Unknown' for c in wanted_digests)
+
+    # Parsing control files and hashing are independent per package and spend
+    # their time in zlib/OpenSSL, which release the GIL: read new packages in
+    # a thread pool, then merge them into the index in the original order.
+    to_read = [abspath for abspath in files
+               if not is_unchanged(_relative_path(abspath, pkg_dir), stats[abspath])]
+    lookahead = READAHEAD_FILES if hasattr(os, "posix_fadvise") else 0
+    for abspath in to_read[:lookahead]:
+        _will_need(abspath)
+    pending = {}
+    executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+    for i, abspath in enumerate(to_read):
+        readahead = to_read[i + lookahead] if lookahead and i + lookahead < len(to_read) else None
+        pending[abspath] = executor.submit(_read_package, abspath, pkg_dir, opt_f,
+                                           wanted_digests, stats[abspath], readahead)
+    executor.shutdown(wait=False)
 
-    files.sort()
     for abspath in files:
         try:
-            filename = os.path.relpath(abspath, pkg_dir)
+            filename = _relative_path(abspath, pkg_dir)
             pkg = None
-            stat = os.stat(abspath)
+            stat = stats[abspath]
             if filename in old_pkg_hash:
-                if filename in pkgs_stamps and int(stat.st_ctime) == pkgs_stamps[filename]:
+                if is_unchanged(filename, stat):
                     if verbose:
                         sys.stderr.write("Found %s in Packages\n" % (filename,))
                     pkg = old_pkg_hash[filename]
@@ -809,7 +1034,10 @@ def make_index(pkg_dir, packages_filename=None, filelist_filename=None, old_file
             if not pkg:
                 if verbose:
                     sys.stderr.write("Reading info for package %s\n" % (filename,))
-                pkg = Package(abspath, relpath=pkg_dir, all_fields=opt_f)
+                if abspath in pending:
+                    pkg = pending.pop(abspath).result()
+                else:
+                    pkg = Package(abspath, relpath=pkg_dir, all_fields=opt_f, stat=stat)
 
             if opt_a:
                 pkg_key = ("%s:%s:%s" % (pkg.package, pkg.architecture, pkg.version))
@@ -839,9 +1067,10 @@ def make_index(pkg_dir, packages_filename=None, filelist_filename=None, old_file
             continue
 
     try:
-        with open(stamplist_filename, "w") as pkgs_stamps_file:
-            for filename in list(pkgs_stamps.keys()):
-                pkgs_stamps_file.write("%d %s\n" % (pkgs_stamps[filename], filename))
+        _write_stamps(stamplist_filename, pkgs_stamps)
+        # Drop the text stamp file of older versions; it is never read again
+        if os.path.exists(stamplist_filename[:-3]):
+            os.unlink(stamplist_filename[:-3])
     except (IOError, OSError):
         pass
 
@@ -852,75 +1081,79 @@ def make_index(pkg_dir, packages_filename=None, filelist_filename=None, old_file
         sys.stderr.write("Generating Packages file\n")
     if packages_filename:
         tmp_packages_filename = ("%s.%d" % (packages_filename, os.getpid()))
-        pkgs_file = open(tmp_packages_filename, "w")
-    names = list(packages.packages.keys())
-    names.sort()
+        gzip_filename = ("%s.gz" % packages_filename)
+        tmp_gzip_filename = ("%s.%d" % (gzip_filename, os.getpid()))
+        pkgs_writer = PackagesWriter(tmp_packages_filename, tmp_gzip_filename)
+    names = sorted(packages.packages)
+    index = {}
+    if filelist_filename:
+        # File lists are extracted in the background (gzip/xz work that
+        # releases the GIL) while Packages is being written
+        filelist_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        file_lists = []
     for name in names:
         try:
             pkg = packages.packages[name]
             if locales_dir and pkg.depends:
-                depends = pkg.depends.split(',')
                 locale = None
-                for depend in depends:
-                    match = re.match('.*virtual-locale-([a-zA-Z]+).*', depend)
-                    match_by_pkg = re.match('locale-base-([a-zA-Z]+)([-+])?.*', pkg.package)
-                    if match:
-                        locale = match.group(1)
-                    if match_by_pkg:
-                        locale = match_by_pkg.group(1)
+                match = _LOCALE_PKG_RE.match(pkg.package)
+                if match:
+                    locale = match.group(1)
+                elif 'virtual-locale-' in pkg.depends:
+                    # The last matching dependency wins
+                    for depend in reversed(pkg.depends.split(',')):
+                        match = _LOCALE_DEP_RE.search(depend)
+                        if match:
+                            locale = match.group(1)
+                            break
                 if locale:
                     to_locale(pkg.filename, locale, pkg_dir, locales_dir, verbose)
                     continue
             if verbose:
                 sys.stderr.write("Writing info for package %s\n" % (pkg.package,))
             if packages_filename:
-                pkgs_file.write(pkg.print(checksum))
+                pkgs_writer.write(pkg.print(checksum))
             else:
                 print(pkg.print(checksum))
+            if return_index and pkg.package and pkg.version:
+                index[pkg.package.strip()] = pkg.version.strip()
         except (OSError, IOError) as ex:
             sys.stderr.write("Package write error: %s\n" % (ex,))
             continue
+        finally:
+            if filelist_filename:
+                # Submitted after a possible move to the locales dir, as before
+                file_lists.append(filelist_executor.submit(_read_file_list, packages[name], pkg_dir))
 
     if packages_filename:
-        pkgs_file.close()
-        gzip_filename = ("%s.gz" % packages_filename)
-        tmp_gzip_filename = ("%s.%d" % (gzip_filename, os.getpid()))
-        gzip_cmd = "gzip -9c < %s > %s" % (tmp_packages_filename, tmp_gzip_filename)
-        subprocess.call(gzip_cmd, shell=True)
-        os.rename(tmp_packages_filename, packages_filename)
-        os.rename(tmp_gzip_filename, gzip_filename)
+        pkgs_writer.close()
+        os.replace(tmp_packages_filename, packages_filename)
+        os.replace(tmp_gzip_filename, gzip_filename)
 
     if filelist_filename:
         if verbose:
             sys.stderr.write("Generate Packages.filelist file\n")
-        files_data = {}
-        names = list(packages.packages.keys())
-        names.sort()
-        for name in names:
-            try:
+        files_data = collections.defaultdict(list)
+        with filelist_executor:
+            for name, future in zip(names, file_lists):
                 if verbose:
                     sys.stderr.write("Reading filelist for package '%s'\n" % name)
-                file_list = packages[name].get_file_list_dir(pkg_dir)
-            except (OSError, IOError):
-                continue
-            for filepath in file_list:
-                (_, filename) = os.path.split(filepath)
-                if not filename:
+                file_list = future.result()
+                if file_list is None:
                     continue
-                if filename not in files_data:
-                    files_data[filename] = name + ':' + filepath
-                else:
-                    files_data[filename] = files_data[filename] + ',' + name + ':' + filepath
+                for filepath in file_list:
+                    (_, filename) = os.path.split(filepath)
+                    if not filename:
+                        continue
+                    files_data[filename].append(name + ':' + filepath)
 
         tmp_filelist_filename = ("%s.%d" % (filelist_filename, os.getpid()))
-        with open(tmp_filelist_filename, "w") as tmp_filelist_filename_hdl:
-            names = list(files_data.keys())
-            names.sort()
-            for name in names:
-                tmp_filelist_filename_hdl.write("%s %s\n" % (name, files_data[name]))
-        if posixpath.exists(filelist_filename):
-            os.unlink(filelist_filename)
-        os.rename(tmp_filelist_filename, filelist_filename)
+        with open(tmp_filelist_filename, "wb", buffering=1 << 20) as tmp_filelist_filename_hdl:
+            for name in sorted(files_data):
+                tmp_filelist_filename_hdl.write(("%s %s\n" % (name, ",".join(files_data[name]))).encode("utf-8"))
+        os.replace(tmp_filelist_filename, filelist_filename)
+    if return_index:
+        return index
     return True
 
 def main():
@@ -1,6 +1,7 @@
 import os
 import sys
 import shutil
+import tempfile
 from pathlib import Path
 import crypto_utils
 
@@ -73,9 +74,10 @@ def get_executable_path():
 
 def get_base_dir():
     """Путь к папке, где лежит оригинальный бинарник или скрипт."""
-    return get_executable_path().parent
+    return BINARY_PATH.parent
 
 INTERNAL_DIR = get_internal_dir()
+# Поиск бинарника (resolve, /proc, stat кандидатов) выполняется один раз
 BINARY_PATH = get_executable_path()
 BASE_DIR = get_base_dir()
 
@@ -87,10 +89,39 @@ LOG_FILE = BASE_DIR / "update.log"
 KEYS_DIR = BASE_DIR
 REPO_STORAGE_DIR = BASE_DIR / "www"
 
+def atomic_write(path, data):
+    """
+    Атомарно записывает bytes в файл: временный файл в той же папке,
+    fsync и os.replace. При сбое на диске остается либо старая, либо новая версия.
+    """
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp создает файл с правами 0600, сохраняем права оригинала
+        if path.exists():
+            shutil.copymode(str(path), tmp)
+        os.replace(tmp, str(path))
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+    # fsync каталога фиксирует само переименование
+    dir_fd = os.open(str(path.parent), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
 def ensure_folders():
     """Проверяет и создает необходимые папки при старте."""
-    if not REPO_STORAGE_DIR.exists():
-        REPO_STORAGE_DIR.mkdir(parents=True, exist_ok=True)
+    REPO_STORAGE_DIR.mkdir(parents=True, exist_ok=True)
     
     # Также создаем пустой лог, если его нет
     if not LOG_FILE.exists():
@@ -1,97 +1,149 @@
 #!/usr/bin/env python3
-import os
 import sys
 import json
 import re
+from collections import defaultdict
+from functools import lru_cache
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 from github import Github, GithubException
 
+try:
+    # Faster JSON parser; the stdlib json module is used without it
+    import orjson
+except ImportError:
+    orjson = None
+
 import paths
 
 CONFIG_FILE = paths.CONFIG_JSON
 SOURCES_FILE = paths.SOURCES_JSON
 TRACKING_FILE = paths.TRACKING_LIST
+# Number of tracked repos queried from the GitHub API at the same time
+DISCOVER_WORKERS = 8
+# ETags and parsed releases of the last full responses, kept across restarts
+ETAG_CACHE_FILE = paths.BASE_DIR / "etag_cache.json"
+
+# api_url -> {"etag": ..., "payload": {"tag": ..., "assets": {arch: [...]}}}.
+# Requests carry If-None-Match; a 304 answer is free for the rate limit and
+# has no body. Loaded from ETAG_CACHE_FILE on first use.
+_release_cache = None
+_release_cache_dirty = False
+
+# owner/repo part of an API url: https://api.github.com/repos/owner/repo/...
+_REPO_RE = re.compile(r'repos/([^/]+/[^/]+)')
+
+def json_load(f):
+    """Parse JSON from a file opened in binary mode."""
+    if orjson is not None:
+        return orjson.loads(f.read())
+    return json.load(f)
+
+def json_dumps(data, indent=False):
+    """Serialize to UTF-8 JSON bytes; indent=True gives the 2-space layout of repo_sources.json."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else None)
+    return json.dumps(data, indent=2 if indent else None, ensure_ascii=False).encode('utf-8')
 
 def load_config():
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r') as f:
-            return json.load(f)
-    return {}
+    try:
+        with open(CONFIG_FILE, 'rb') as f:
+            return json_load(f)
+    except FileNotFoundError:
+        return {}
 
 def load_existing_sources_map():
     """Load current sources into a dict keyed by repo name (owner/repo) for easy merging."""
     mapping = {}
-    if os.path.exists(SOURCES_FILE):
-        try:
-            with open(SOURCES_FILE, 'r') as f:
-                data = json.load(f)
-                for item in data:
-                    api_url = item.get('api_url', '')
-                    # Extract owner/repo from https://api.github.com/repos/owner/repo/...
-                    match = re.search(r'repos/([^/]+/[^/]+)', api_url)
-                    if match:
-                        repo_key = match.group(1)
-                        mapping[repo_key] = item
-                    else:
-                        # Fallback to name if api_url is missing or doesn't match
-                        mapping[item.get('name')] = item
-        except:
-            pass
+    # A missing file is handled by the except below, like a corrupt one
+    try:
+        with open(SOURCES_FILE, 'rb') as f:
+            data = json_load(f)
+            for item in data:
+                api_url = item.get('api_url', '')
+                # Extract owner/repo from https://api.github.com/repos/owner/repo/...
+                match = _REPO_RE.search(api_url)
+                if match:
+                    repo_key = match.group(1)
+                    mapping[repo_key] = item
+                else:
+                    # Fallback to name if api_url is missing or doesn't match
+                    mapping[item.get('name')] = item
+    except:
+        pass
     return mapping
 
 def parse_tracking_list():
     """Parse the tracking list file into a list of dicts {owner, repo, tag}."""
     repos = []
-    if not os.path.exists(TRACKING_FILE):
+    # The list is small enough to read at once; splitlines runs in C
+    try:
+        lines = TRACKING_FILE.read_text(encoding='utf-8', errors='ignore').splitlines()
+    except FileNotFoundError:
         return repos
     
-    with open(TRACKING_FILE, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
-            
-            # Logic to extract owner, repo, and optional tag
-            # Matches:
-            # 1. https://github.com/owner/repo/releases/tag/v1.0
-            # 2. https://github.com/owner/repo
-            # 3. owner/repo
-            
-            owner, repo, tag = None, None, None
-            
-            # Remove .git suffix if present
-            if line.endswith('.git'):
-                line = line[:-4]
-
-            if line.startswith('http'):
-                # Handle URL
-                parts = line.split('/')
-                # Find 'github.com' index
-                try:
-                    gh_idx = parts.index('github.com')
-                    if len(parts) > gh_idx + 2:
-                        owner = parts[gh_idx + 1]
-                        repo = parts[gh_idx + 2]
-                        
-                        # Check for tag
-                        if 'releases' in parts and 'tag' in parts:
-                            tag_idx = parts.index('tag')
-                            if len(parts) > tag_idx + 1:
-                                tag = parts[tag_idx + 1]
-                except ValueError:
-                    pass
-            else:
-                # Handle owner/repo string
-                parts = line.split('/')
-                if len(parts) >= 2:
-                    owner = parts[0]
-                    repo = parts[1]
-                    # No tag support in simple string "owner/repo" format yet, unless "owner/repo:tag"
-            
-            if owner and repo:
-                repos.append({'owner': owner, 'repo': repo, 'tag': tag})
-    
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        
+        # Logic to extract owner, repo, and optional tag
+        # Matches:
+        # 1. https://github.com/owner/repo/releases/tag/v1.0
+        # 2. https://github.com/owner/repo
+        # 3. owner/repo
+        
+        owner, repo, tag = None, None, None
+        
+        # Remove .git suffix if present
+        if line.endswith('.git'):
+            line = line[:-4]
+
+        if line.startswith('http'):
+            # Handle URL
+            # Single pass over the path: owner/repo[/releases/tag/<tag>]
+            url = urlparse(line)
+            if url.netloc == 'github.com':
+                segs = url.path.strip('/').split('/')
+                if len(segs) >= 2:
+                    owner, repo = segs[0], segs[1]
+                    if len(segs) >= 5 and segs[2] == 'releases' and segs[3] == 'tag':
+                        tag = segs[4]
+        else:
+            # Handle owner/repo string
+            parts = line.split('/')
+            if len(parts) >= 2:
+                owner = parts[0]
+                repo = parts[1]
+                # No tag support in simple string "owner/repo" format yet, unless "owner/repo:tag"
+        
+        if owner and repo:
+            repos.append({'owner': owner, 'repo': repo, 'tag': tag})
+
     return repos
 
+# Filename tokens are separated by '_' or '-': "pkg_ver_arch.ipk", "pkg-ver-arch.ipk"
+_UNIVERSAL_TOKEN_RE = re.compile(r'(?:^|[_-])(?:all|noarch)(?:[_-]|$)')
+# The first token starting with a known arch prefix begins the arch string
+_ARCH_TOKEN_RE = re.compile(
+    r'(?:^|[_-])((?:x86|amd64|aarch64|arm|mips|i386|powerpc|riscv|loongarch).*)', re.S)
+
+# Asset names repeat across releases and discovery runs
+@lru_cache(maxsize=4096)
+def _classify_ipk(lname):
+    """Arch of an already lowercased filename ending in '.ipk'."""
+    base = lname[:-4]
+    if _UNIVERSAL_TOKEN_RE.search(base):
+        return 'all'
+
+    match = _ARCH_TOKEN_RE.search(base)
+    if match:
+        # Normalized form: the remaining tokens joined by underscore
+        return match.group(1).replace('-', '_')
+            
+    if 'luci-' in lname: return 'all'
+    return 'unknown'
+
 def get_arch_from_filename(filename):
     """
     Extracts the raw architecture string from the filename.
@@ -99,39 +151,127 @@ def get_arch_from_filename(filename):
     filename = filename.lower()
     if not filename.endswith('.ipk'):
         return 'unknown'
+    return _classify_ipk(filename)
+
+def load_release_cache():
+    """Load the persisted ETag cache once per process."""
+    global _release_cache
+    if _release_cache is None:
+        cache = {}
+        try:
+            with open(ETAG_CACHE_FILE, 'rb') as f:
+                data = json_load(f)
+            if isinstance(data, dict):
+                cache = data
+        except (OSError, ValueError):
+            pass
+        _release_cache = cache
+    return _release_cache
+
+def save_release_cache(api_urls):
+    """Persist the cache entries of the current sources; entries of untracked repos are dropped."""
+    global _release_cache_dirty
+    cache = load_release_cache()
+    for api_url in set(cache) - set(api_urls):
+        del cache[api_url]
+        _release_cache_dirty = True
+    if not _release_cache_dirty:
+        return
+    paths.atomic_write(ETAG_CACHE_FILE, json_dumps(cache))
+    _release_cache_dirty = False
+
+def group_assets(assets):
+    """Group the .ipk assets of a release JSON by architecture, for the UI."""
+    assets_data = defaultdict(list)
+    for asset in assets:
+        # Cheap suffix test first: sources, checksums and signatures are skipped
+        name = asset['name']
+        if not name.endswith('.ipk'):
+            continue
         
-    base = filename[:-4]
-    # Split by underscore OR hyphen to handle various naming conventions
-    # e.g. "pkg_ver_arch.ipk" or "pkg-ver-arch.ipk"
-    parts = re.split(r'[_-]', base)
+        # Suffix already checked above: only lowercase and classify
+        assets_data[_classify_ipk(name.lower())].append({
+            "name": name,
+            "url": asset['browser_download_url'],
+            "size": asset['size']
+        })
+    return dict(assets_data)
+
+def fetch_release(g, api_url, force=False):
+    """
+    GET a release: {"tag", "assets"}. Unchanged releases (304) come from the cache;
+    a forced request is unconditional so it can refresh a bad cache entry.
+    """
+    global _release_cache_dirty
+    cache = load_release_cache()
+    cached = cache.get(api_url)
+    headers = {"If-None-Match": cached["etag"]} if cached and not force else None
+    response_headers, data = g.requester.requestJsonAndCheck("GET", api_url, headers=headers)
+    if data is None and cached:
+        # 304 Not Modified: nothing to parse or group
+        return cached["payload"]
+
+    # Assets may be uploaded after the tag is published: always regroup a full response
+    release = {"tag": data["tag_name"], "assets": group_assets(data.get("assets", []))}
+    etag = response_headers.get("etag")
+    if etag:
+        cache[api_url] = {"etag": etag, "payload": release}
+        _release_cache_dirty = True
+    return release
+
+def _discover_one(g, target, existing_map, force):
+    """Query one tracked repo. Returns (UI result, sources entry or None)."""
+    full_name = f"{target['owner']}/{target['repo']}"
+    pinned_tag = target['tag']
     
-    arch_prefixes = (
-        'x86', 'amd64', 'aarch64', 'arm', 
-        'mips', 'i386', 'powerpc', 'riscv', 'loongarch'
-    )
+    # Merge previous settings
+    prev_entry = existing_map.get(full_name, {})
     
-    if 'all' in parts or 'noarch' in parts:
-        return 'all'
+    # Basic entry structure
+    entry = {
+        "name": full_name,
+        "api_url": "", # Will be filled below
+        "filter_arch": prev_entry.get('filter_arch', 'all'), # Preserve or default
+        "exclude_asset_keywords": prev_entry.get('exclude_asset_keywords', []),
+        "last_tag": prev_entry.get('last_tag', '')
+    }
+    
+    try:
+        # The release endpoint is queried directly, without fetching the repo
+        if pinned_tag:
+            entry['api_url'] = f"https://api.github.com/repos/{full_name}/releases/tags/{pinned_tag}"
+        else:
+            entry['api_url'] = f"https://api.github.com/repos/{full_name}/releases/latest"
+        release = fetch_release(g, entry['api_url'], force)
 
-    for i, part in enumerate(parts):
-        if part.startswith('v') and part[1:].isdigit():
-            continue
-        if part.startswith(arch_prefixes):
-            # Reconstruct the arch string from the remaining parts
-            # We prefer underscore for the resulting arch name if possible, 
-            # but here we just return the raw suffix found in the file.
-            # Since we split by regex, we need to be careful how we join back if needed.
-            # For simplest match, just returning the found part and subsequent parts 
-            # joined by underscore is usually the convention in OpenWrt feeds,
-            # but here we might just want to return the part that matched + specific suffixes.
-            
-            # Simplified approach: return the rest of the string from the original filename 
-            # starting from this part? No, that's hard because we split it.
-            # Let's just join the remaining parts with underscore as a normalized form
-            return "_".join(parts[i:])
+        latest_tag = release['tag']
+        
+        # Check if updated (compare with JSON's last_tag)
+        is_new = (latest_tag != entry['last_tag'])
+        entry['last_tag'] = latest_tag # Update tag in config
+        
+        # Prepare result for UI
+        status = "updated" if is_new else "skipped"
+        if force: status = "forced"
+        
+        return {
+            "name": full_name,
+            "status": status,
+            "tag": latest_tag,
+            "assets": release['assets']
+        }, entry
+
+    except GithubException as e:
+        # Still keep old entry if fetch fails? 
+        # Better to keep it so we don't lose config on temporary network error
+        if prev_entry:
+            prev_entry.pop('selected_assets', None)
+        return {"name": full_name, "error": str(e)}, prev_entry or None
             
-    if 'luci-' in filename: return 'all'
-    return 'unknown'
+    except Exception as e:
+        if prev_entry:
+            prev_entry.pop('selected_assets', None)
+        return {"name": full_name, "error": f"Error: {str(e)}"}, prev_entry or None
 
 def discover_releases(force=False):
     config = load_config()
@@ -148,90 +288,30 @@ def discover_releases(force=False):
     # 2. Load existing config to preserve user settings
     existing_map = load_existing_sources_map()
     
-    results = []     # For UI display
-    new_config = []  # For saving to repo_sources.json
+    # Loaded here, not lazily in the workers: concurrent first loads would
+    # each create their own dict and drop the entries of the others
+    load_release_cache()
 
-    for target in targets:
-        full_name = f"{target['owner']}/{target['repo']}"
-        pinned_tag = target['tag']
-        
-        # Merge previous settings
-        prev_entry = existing_map.get(full_name, {})
-        
-        # Basic entry structure
-        entry = {
-            "name": full_name,
-            "api_url": "", # Will be filled below
-            "filter_arch": prev_entry.get('filter_arch', 'all'), # Preserve or default
-            "exclude_asset_keywords": prev_entry.get('exclude_asset_keywords', []),
-            "last_tag": prev_entry.get('last_tag', '')
-        }
-        
-        try:
-            gh_repo = g.get_repo(full_name)
-            
-            if pinned_tag:
-                release = gh_repo.get_release(pinned_tag)
-                entry['api_url'] = f"https://api.github.com/repos/{full_name}/releases/tags/{pinned_tag}"
-            else:
-                release = gh_repo.get_latest_release()
-                entry['api_url'] = f"https://api.github.com/repos/{full_name}/releases/latest"
-
-            latest_tag = release.tag_name
-            
-            # Check if updated (compare with JSON's last_tag)
-            is_new = (latest_tag != entry['last_tag'])
-            entry['last_tag'] = latest_tag # Update tag in config
-            
-            # Scan assets for UI
-            assets_data = {}
-            for asset in release.get_assets():
-                if not asset.name.endswith('.ipk'):
-                    continue
-                
-                arch = get_arch_from_filename(asset.name)
-                if arch not in assets_data:
-                    assets_data[arch] = []
-                
-                assets_data[arch].append({
-                    "name": asset.name,
-                    "url": asset.browser_download_url,
-                    "size": asset.size
-                })
-            
-            # Prepare result for UI
-            status = "updated" if is_new else "skipped"
-            if force: status = "forced"
-            
-            results.append({
-                "name": full_name,
-                "status": status,
-                "tag": latest_tag,
-                "assets": assets_data
-            })
-            
-            # Add to new config list
-            new_config.append(entry)
-
-        except GithubException as e:
-            results.append({"name": full_name, "error": str(e)})
-            # Still keep old entry if fetch fails? 
-            # Better to keep it so we don't lose config on temporary network error
-            if prev_entry:
-                prev_entry.pop('selected_assets', None)
-                new_config.append(prev_entry)
-                
-        except Exception as e:
-            results.append({"name": full_name, "error": f"Error: {str(e)}"})
-            if prev_entry:
-                prev_entry.pop('selected_assets', None)
-                new_config.append(prev_entry)
+    # Each target costs several blocking API round-trips; the wait is on the
+    # network, so query the targets in parallel and keep the list order.
+    with ThreadPoolExecutor(max_workers=DISCOVER_WORKERS) as pool:
+        outcomes = list(pool.map(lambda target: _discover_one(g, target, existing_map, force), targets))
+
+    results = [result for result, _ in outcomes]                         # For UI display
+    new_config = [entry for _, entry in outcomes if entry is not None]  # For saving to repo_sources.json
+
+    try:
+        save_release_cache([entry.get('api_url') for entry in new_config])
+    except OSError:
+        # Only a cache: the next run simply fetches full responses again
+        pass
 
     # 3. Save the regenerated config to repo_sources.json automatically
     # This makes the tracking list the single source of truth for *which* repos exist.
     try:
-        with open(SOURCES_FILE, 'w') as f:
-            json.dump(new_config, f, indent=2)
+        # Encoded in one go and swapped in atomically: a crash mid-write
+        # cannot leave a truncated repo_sources.json behind
+        paths.atomic_write(SOURCES_FILE, json_dumps(new_config, indent=True))
     except Exception as e:
         results.append({"error": f"Failed to save repo_sources.json: {e}"})
 
@@ -2,13 +2,14 @@
 import os
 import sys
 import json
+import logging
 import shutil
-import re
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-import urllib.request
-import urllib.error
+import urllib3
 import paths
 
 from logger_utils import logger
@@ -17,7 +18,30 @@ from logger_utils import logger
 REPO_SOURCES = paths.SOURCES_JSON
 REPO_ROOT = paths.REPO_STORAGE_DIR
 LOG_FILE = paths.LOG_FILE
-TMP_DIR = paths.BASE_DIR / ".tmp_repo"
+# Файл докачивается рядом с целевым (та же ФС) и встает на место через os.replace
+PART_SUFFIX = ".part"
+# Метки универсальных пакетов (all/noarch), ищутся в имени в нижнем регистре
+_UNIVERSAL_TOKENS = ('_all', '_noarch', '-all', '-noarch')
+# ETag/Last-Modified и сокращенное тело последнего ответа по каждому api_url
+ETAG_CACHE_FILE = paths.BASE_DIR / "sync_etag_cache.json"
+# Число параллельных запросов к GitHub API при получении данных о релизах
+FETCH_WORKERS = 8
+# Число одновременно скачиваемых файлов пакета
+DOWNLOAD_WORKERS = 8
+
+# Размер блока при записи скачиваемого файла (штатный в copyfileobj - 64 КиБ)
+DOWNLOAD_CHUNK = 1 << 20
+
+# Общий пул соединений: keep-alive к api.github.com и CDN ассетов вместо
+# нового TCP+TLS соединения на каждый запрос. Потокобезопасен.
+HTTP = urllib3.PoolManager(
+    num_pools=4,
+    maxsize=max(FETCH_WORKERS, DOWNLOAD_WORKERS),
+    retries=urllib3.Retry(total=3, backoff_factor=0.5),
+    headers={'User-Agent': 'Mozilla/5.0 (compatible; OpenWrtRepoManager/1.0)'}
+)
+# Корневой логгер пишет INFO в update.log; редиректы на CDN туда не нужны
+logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 def log(message):
     """Логирование через центральный логгер."""
@@ -26,89 +50,198 @@ def log(message):
 def download_file(url, dest_path):
     """Скачивание файла по URL."""
     try:
-        req = urllib.request.Request(
-            url, 
-            data=None, 
-            headers={
-                'User-Agent': 'Mozilla/5.0 (compatible; OpenWrtRepoManager/1.0)'
-            }
-        )
-        with urllib.request.urlopen(req) as response, open(dest_path, 'wb') as out_file:
-            shutil.copyfileobj(response, out_file)
+        response = HTTP.request('GET', url, preload_content=False)
+        try:
+            if response.status >= 400:
+                raise urllib3.exceptions.HTTPError(f"HTTP Error {response.status}: {response.reason}")
+            with open(dest_path, 'wb') as out_file:
+                # Место под файл известного размера резервируется сразу:
+                # меньше фрагментации при параллельных загрузках
+                length = response.headers.get('Content-Length')
+                if length and length.isdigit() and hasattr(os, 'posix_fallocate'):
+                    try:
+                        os.posix_fallocate(out_file.fileno(), 0, int(length))
+                    except OSError:
+                        pass
+                shutil.copyfileobj(response, out_file, DOWNLOAD_CHUNK)
+                # Если тело оказалось короче заявленного - убираем хвост резерва
+                out_file.truncate()
+        finally:
+            response.release_conn()
         return True
     except Exception as e:
         log(f"   ❌ Ошибка скачивания {url}: {e}")
         return False
 
-def get_json(url):
-    """Получение JSON по URL."""
+def fetch_asset(asset, dest_file):
+    """Скачивает ассет в скрытый .part рядом с целевым файлом и атомарно переименовывает. True при успехе."""
+    temp_file = dest_file.with_name(f".{dest_file.name}{PART_SUFFIX}")
+    if download_file(asset.get('browser_download_url'), temp_file):
+        try:
+            os.replace(temp_file, dest_file)
+            return True
+        except Exception as e:
+            log(f"   ❌ Ошибка перемещения файла: {e}")
+    try:
+        temp_file.unlink()
+    except FileNotFoundError:
+        pass
+    return False
+
+def scan_repo(root, ipk_files, dirs):
+    """
+    Рекурсивный обход через os.scandir (данные dirent, без Path и stat на файл):
+    пути .ipk собираются в ipk_files, подпапки в dirs (дочерние раньше родителя),
+    хвосты прерванных загрузок (.part) удаляются.
+    """
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                scan_repo(entry.path, ipk_files, dirs)
+                dirs.append(entry.path)
+            elif entry.name.endswith('.ipk'):
+                ipk_files.add(entry.path)
+            elif entry.name.endswith(PART_SUFFIX):
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    pass
+
+def load_etag_cache():
+    """Читает кэш условных запросов; при отсутствии или порче - пустой."""
+    try:
+        with open(ETAG_CACHE_FILE, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def save_etag_cache(cache, api_urls):
+    """Сохраняет кэш, отбрасывая записи удаленных источников."""
+    for url in set(cache) - set(api_urls):
+        del cache[url]
+    try:
+        paths.atomic_write(ETAG_CACHE_FILE, json.dumps(cache, ensure_ascii=False).encode('utf-8'))
+    except OSError as e:
+        log(f"⚠️ [SYNC] Не удалось сохранить {ETAG_CACHE_FILE.name}: {e}")
+
+def get_json(url, cache=None):
+    """
+    Получение JSON по URL. С кэшем запрос условный (If-None-Match/If-Modified-Since):
+    на 304 тело не передается и берется из кэша. Запрос идет без токена, поэтому
+    304 все равно учитывается в лимите GitHub API для анонимных запросов.
+    Возвращает (data, not_modified).
+    """
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (compatible; OpenWrtRepoManager/1.0)',
+        'Accept': 'application/vnd.github.v3+json'
+    }
+    cached = cache.get(url) if cache is not None else None
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
     try:
-        req = urllib.request.Request(
-            url, 
-            data=None, 
-            headers={
-                'User-Agent': 'Mozilla/5.0 (compatible; OpenWrtRepoManager/1.0)',
-                'Accept': 'application/vnd.github.v3+json'
+        response = HTTP.request('GET', url, headers=headers)
+        if response.status == 304 and cached:
+            return cached['body'], True
+        if response.status >= 400:
+            raise urllib3.exceptions.HTTPError(f"HTTP Error {response.status}: {response.reason}")
+        data = json.loads(response.data)
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if cache is not None and isinstance(data, dict) and (etag or last_modified):
+            # Хранится только то, что нужно синхронизации
+            cache[url] = {
+                "etag": etag,
+                "last_modified": last_modified,
+                "body": {
+                    "tag_name": data.get('tag_name'),
+                    "assets": [
+                        {"name": a.get('name'), "browser_download_url": a.get('browser_download_url'), "size": a.get('size')}
+                        for a in data.get('assets', [])
+                    ]
+                }
             }
-        )
-        with urllib.request.urlopen(req) as response:
-            return json.loads(response.read().decode('utf-8'))
+        return data, False
     except Exception as e:
         log(f"   ❌ Ошибка доступа к API {url}: {e}")
-        return None
+        return None, False
 
 def run():
     log("🚀 [SYNC] Запуск синхронизации пакетов...")
-    
-    if not TMP_DIR.exists():
-        TMP_DIR.mkdir(parents=True, exist_ok=True)
-        
-    if not REPO_SOURCES.exists():
-        log(f"❌ [SYNC] Ошибка: Источники {REPO_SOURCES} не найдены.")
-        return False
+
+    # Старые версии скачивали файлы через .tmp_repo - удаляем остатки
+    shutil.rmtree(paths.BASE_DIR / ".tmp_repo", ignore_errors=True)
 
     try:
         with open(REPO_SOURCES, "r", encoding="utf-8") as f:
             sources = json.load(f)
+    except FileNotFoundError:
+        log(f"❌ [SYNC] Ошибка: Источники {REPO_SOURCES} не найдены.")
+        return False
     except json.JSONDecodeError as e:
         log(f"❌ [SYNC] Ошибка парсинга {REPO_SOURCES}: {e}")
         return False
 
     updates_found = False
     has_network_errors = False
+    # Absolute path strings; the root is resolved once instead of every file
+    repo_root = REPO_ROOT.resolve()
     global_expected_files = set()
 
-    for pkg in sources:
+    # Данные о релизах запрашиваются параллельно: это чистое ожидание сети,
+    # а дальнейшая обработка пакетов идет последовательно.
+    etag_cache = load_etag_cache()
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        releases = list(pool.map(lambda pkg: get_json(pkg.get('api_url'), etag_cache), sources))
+    save_etag_cache(etag_cache, [pkg.get('api_url') for pkg in sources])
+
+    for pkg, (release_data, not_modified) in zip(sources, releases):
         name = pkg.get('name')
         arch = pkg.get('filter_arch')
-        api_url = pkg.get('api_url')
         exclude_keywords = pkg.get('exclude_asset_keywords', [])
         
         # New feature: Selected Assets
-        selected_assets = pkg.get('selected_assets', []) # List of filenames
+        # Set of filenames: O(1) membership test per asset
+        selected_assets = frozenset(pkg.get('selected_assets', []))
 
         target_dir = REPO_ROOT / arch
-        if not target_dir.exists():
-            try:
-                target_dir.mkdir(parents=True, exist_ok=True)
-            except Exception as e:
-                log(f"❌ [SYNC] Не удалось создать директорию {target_dir}: {e}")
-                continue
+        try:
+            # Existing directory: one failed mkdir instead of stat + mkdir
+            target_dir.mkdir(parents=True, exist_ok=True)
+        except Exception as e:
+            log(f"❌ [SYNC] Не удалось создать директорию {target_dir}: {e}")
+            continue
 
         log(f"🔎 [SYNC] Проверка: {name} ({arch})")
 
-        release_data = get_json(api_url)
         if not release_data or 'assets' not in release_data:
             log(f"   ❌ [SYNC] Нет данных о релизах для {name}")
             has_network_errors = True
             continue
 
+        if not_modified:
+            # Список файлов тот же; локальные фазы все равно выполняются:
+            # они дешевые и досинхронизируют файлы после прошлых сбоев
+            log("   💤 [SYNC] Релиз не изменился (304)")
+
         assets = release_data.get('assets', [])
         ipk_assets = [a for a in assets if a.get('name', '').endswith('.ipk')]
 
         # Phase 1: Identify files to sync
         files_to_sync = []
         prefixes_in_release = set()
+
+        # Loop invariants and bound methods hoisted out of the per-asset loop
+        accept = files_to_sync.append
+        add_prefix = prefixes_in_release.add
+        add_expected = global_expected_files.add
+        target_path = os.path.join(repo_root, arch)
+        arch_is_all = arch == "all"
+        arch_is_x86_64 = arch == "x86_64"
         
         for asset in ipk_assets:
             file_name = asset.get('name')
@@ -120,7 +253,7 @@ def run():
             # --- Start Logic Update ---
             is_ok = False
             
-            if selected_assets and len(selected_assets) > 0:
+            if selected_assets:
                 # 1. Exact match mode (if list is populated)
                 if file_name in selected_assets:
                     is_ok = True
@@ -128,26 +261,23 @@ def run():
                     is_ok = False # Skip everything else if user was specific
             else:
                 # 2. Heuristic/Regex mode (Smart Filter)
+                lower_name = file_name.lower()
                 
                 # Check exclusions first
-                is_excluded = False
-                for kw in exclude_keywords:
-                    if kw in file_name:
-                        is_excluded = True
-                        break
+                is_excluded = any(kw in file_name for kw in exclude_keywords)
                 
                 # Auto-exclude entware packages as they break opkg-make-index (different structure)
                 # and are not compatible with standard OpenWrt
-                if 'entware' in file_name.lower():
+                if 'entware' in lower_name:
                     is_excluded = True
 
                 if is_excluded:
                     continue
 
                 # Universal packages are always welcome unless explicitly excluded
-                is_universal = re.search(r'(_all|_noarch|-all|-noarch)', file_name, re.IGNORECASE)
+                is_universal = any(token in lower_name for token in _UNIVERSAL_TOKENS)
 
-                if arch == "all":
+                if arch_is_all:
                     if is_universal:
                         is_ok = True
                 else:
@@ -158,60 +288,75 @@ def run():
                     elif is_universal:
                         is_ok = True
 
-                    if arch == "x86_64" and "amd64" in file_name:
+                    if arch_is_x86_64 and "amd64" in file_name:
                         is_ok = True
             
             # --- End Logic Update ---
 
             if is_ok:
-                files_to_sync.append(asset)
+                accept(asset)
                 # Track for global cleanup
-                global_expected_files.add((target_dir / file_name).resolve())
+                add_expected(os.path.join(target_path, file_name))
                 
                 # Calculate prefix for cleanup (name before version)
                 # Assuming standard format: name_version_arch.ipk
-                parts = file_name.split('_')
-                if len(parts) > 1:
-                    prefixes_in_release.add(parts[0])
+                prefix, sep, _ = file_name.partition('_')
+                if sep:
+                    add_prefix(prefix)
 
         # Phase 2: Download
         target_file_names = {a.get('name') for a in files_to_sync}
 
+        # One directory scan serves both the existence checks here and the
+        # cleanup below (downloads only add names from target_file_names)
+        with os.scandir(target_dir) as entries:
+            on_disk = {entry.name: entry for entry in entries if entry.name.endswith('.ipk')}
+
+        pending = []
         for asset in files_to_sync:
             file_name = asset.get('name')
-            download_url = asset.get('browser_download_url')
             dest_file = target_dir / file_name
             
-            if not dest_file.exists():
+            entry = on_disk.get(file_name)
+            if entry is None:
                 log(f"   ⬇️  [SYNC] Найдена новая версия: {file_name}")
-                
-                temp_file = TMP_DIR / file_name
-                if download_file(download_url, temp_file):
-                    try:
-                        shutil.move(str(temp_file), str(dest_file))
-                        updates_found = True
-                    except Exception as e:
-                        log(f"   ❌ Ошибка перемещения файла: {e}")
-                else:
-                    if temp_file.exists():
-                        temp_file.unlink()
+                pending.append((asset, dest_file))
+                continue
+            local_size = entry.stat().st_size
+
+            # Недокачанный или перезалитый под тем же именем файл: размер
+            # из JSON релиза не совпадает с локальным
+            expected_size = asset.get('size')
+            if expected_size is not None and local_size != expected_size:
+                log(f"   ⬇️  [SYNC] Размер {file_name} не совпадает ({local_size} != {expected_size}), скачиваем заново")
+                pending.append((asset, dest_file))
+
+        # Скачивание упирается в задержки сети, файлы качаются параллельно
+        if pending:
+            with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+                if any(list(pool.map(lambda job: fetch_asset(*job), pending))):
+                    updates_found = True
 
         # Phase 3: Local Cleanup (Old versions of ACTIVE packages)
         # Remove files that match the prefixes of updated packages but are NOT in the current sync list
-        for prefix in prefixes_in_release:
-            for existing_file in target_dir.glob(f"{prefix}_*.ipk"):
-                if existing_file.name not in target_file_names:
-                    log(f"   🧹 [SYNC] Удаление устаревшей версии/варианта: {existing_file.name}")
-                    try:
-                        existing_file.unlink()
-                        updates_found = True
-                    except Exception as e:
-                        log(f"   ⚠️ Не удалось удалить {existing_file.name}: {e}")
+        # Steady state: everything on disk is in the current list, nothing to clean
+        if on_disk.keys() <= target_file_names:
+            continue
 
-    try:
-        shutil.rmtree(TMP_DIR)
-    except Exception as e:
-        pass
+        # Stale files grouped by prefix instead of a glob per prefix
+        by_prefix = defaultdict(list)
+        for existing_name in on_disk.keys() - target_file_names:
+            if '_' in existing_name:
+                by_prefix[existing_name.split('_', 1)[0]].append(existing_name)
+
+        for prefix in prefixes_in_release & by_prefix.keys():
+            for existing_name in by_prefix[prefix]:
+                log(f"   🧹 [SYNC] Удаление устаревшей версии/варианта: {existing_name}")
+                try:
+                    (target_dir / existing_name).unlink()
+                    updates_found = True
+                except Exception as e:
+                    log(f"   ⚠️ Не удалось удалить {existing_name}: {e}")
 
     # Phase 4: Global Garbage Collection (Orphans)
     # Only run if we had NO network errors (to prevent wiping repo if GitHub is down)
@@ -219,27 +364,31 @@ def run():
         log("🧹 [GC] Проверка на наличие осиротевших файлов...")
         orphan_count = 0
         
-        # Scan all .ipk files in the repo root recursively
-        for file_path in REPO_ROOT.rglob("*.ipk"):
+        # One scan collects the .ipk files and the subdirectories (children
+        # before their parent); orphans are a set difference
+        existing_files = set()
+        all_dirs = []
+        # www/ may not exist yet (first run with no sources)
+        if repo_root.is_dir():
+            scan_repo(str(repo_root), existing_files, all_dirs)
+
+        for file_path in sorted(existing_files - global_expected_files):
             try:
-                # Resolve ensures we have absolute path to compare
-                if file_path.resolve() not in global_expected_files:
-                    log(f"   🗑️ [GC] Удаление осиротевшего файла: {file_path.name}")
-                    file_path.unlink()
-                    orphan_count += 1
-                    updates_found = True
+                log(f"   🗑️ [GC] Удаление осиротевшего файла: {os.path.basename(file_path)}")
+                os.unlink(file_path)
+                orphan_count += 1
+                updates_found = True
             except Exception as e:
                 log(f"   ⚠️ [GC] Ошибка удаления {file_path}: {e}")
-        
+
         # Cleanup empty directories
-        for dir_path in REPO_ROOT.rglob("*"):
-            if dir_path.is_dir():
-                try:
-                    # rmdir fails if not empty, which is what we want
-                    dir_path.rmdir()
-                    log(f"   🗑️ [GC] Удалена пустая папка: {dir_path.name}")
-                except OSError:
-                    pass # Directory not empty
+        for dir_path in all_dirs:
+            try:
+                # rmdir fails if not empty, which is what we want
+                os.rmdir(dir_path)
+                log(f"   🗑️ [GC] Удалена пустая папка: {os.path.basename(dir_path)}")
+            except OSError:
+                pass # Directory not empty
     else:
         log("⚠️ [GC] Пропущен из-за ошибок сети (безопасный режим)")
 
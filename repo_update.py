@@ -8,30 +8,60 @@ from logger_utils import logger
 # Глобальный лок для предотвращения одновременного запуска обновлений
 update_lock = threading.Lock()
 
+def _run_pipeline():
+    """Sync + Publish. Вызывается только при захваченном update_lock."""
+    logger.info("🔄 Начинаем полный цикл обновления репозитория...")
+    
+    # 1. Запуск синхронизации (скачивание)
+    # repo_sync.run() возвращает True, если были изменения, или если всё прошло успешно
+    # В нашей логике, если sync вернул False (ошибка), то прерываемся.
+    if not repo_sync.run():
+        logger.error("❌ Синхронизация не удалась или завершилась с ошибкой. Прерывание.")
+        return False
+
+    # 2. Запуск публикации (сборка индексов)
+    # repo_publish.run() возвращает True/False
+    if not repo_publish.run():
+        logger.error("❌ Публикация не удалась.")
+        return False
+        
+    logger.info("✅ Полный цикл обновления завершен.")
+    return True
+
 def run_all():
     """Запускает полный цикл обновления репозитория (Sync + Publish)."""
-    if update_lock.locked():
+    # Проверка и захват лока одной атомарной операцией:
+    # отдельный locked() перед with оставлял окно для двух запусков подряд.
+    if not update_lock.acquire(blocking=False):
         logger.warning("⚠️ Обновление уже запущено! Пропуск.")
         return False
+    try:
+        return _run_pipeline()
+    finally:
+        update_lock.release()
 
-    with update_lock:
-        logger.info("🔄 Начинаем полный цикл обновления репозитория...")
-        
-        # 1. Запуск синхронизации (скачивание)
-        # repo_sync.run() возвращает True, если были изменения, или если всё прошло успешно
-        # В нашей логике, если sync вернул False (ошибка), то прерываемся.
-        if not repo_sync.run():
-            logger.error("❌ Синхронизация не удалась или завершилась с ошибкой. Прерывание.")
-            return False
-
-        # 2. Запуск публикации (сборка индексов)
-        # repo_publish.run() возвращает True/False
-        if not repo_publish.run():
-            logger.error("❌ Публикация не удалась.")
-            return False
-            
-        logger.info("✅ Полный цикл обновления завершен.")
-        return True
+def start_background():
+    """
+    Запускает полный цикл в фоновом потоке.
+    Возвращает False, если обновление уже выполняется.
+    """
+    # Лок захватывается в вызывающем потоке, чтобы повторный запрос
+    # сразу получил отказ, а не запустил поток, который тут же завершится.
+    if not update_lock.acquire(blocking=False):
+        return False
+
+    def worker():
+        try:
+            _run_pipeline()
+        finally:
+            update_lock.release()
+
+    try:
+        threading.Thread(target=worker, daemon=True).start()
+    except Exception:
+        update_lock.release()
+        raise
+    return True
 
 if __name__ == "__main__":
     run_all()